@@ -26,6 +26,9 @@ config = {
         "dependencies": [
             "pyperclip >= 1.8.0"
         ],
+        "optional-dependencies": {
+            "lazy-copy": ["python-xlib"]
+        },
     },
     "tool.setuptools.packages.find": {
         "where": ["src"],
@@ -35,7 +38,8 @@ config = {
 }
 
 HOST_SCRIPTS = {
-    "clipdis_run": "clipdis.run_watcher:run"
+    "clipdis_run": "clipdis.run_watcher:run",
+    "clipdis_trace": "clipdis.trace:run"
 }
 
 CONTAINER_SCRIPTS = {
@@ -0,0 +1,158 @@
+from enum import Enum
+from time import monotonic
+from typing import Dict, Optional
+
+# Admission control of the watcher. A request is checked before any work is
+# done: a payload above the size limit, or a request of a source, which used
+# up its rate or bandwidth, is rejected right away with the reason in the
+# response, so a runaway client gets an error instead of keeping the host
+# clipboard busy. A source is the session of the client process, or the name
+# in CLIPDIS_SOURCE, and each one has its own token buckets. Requests are not
+# queued here: clients of a lane are serialized by the lane lock, so the
+# watcher never has more than one request per lane to choose from.
+
+# buckets of idle sources are dropped, when there are more sources
+_max_sources = 1024
+
+
+class Reason(Enum):
+    TOO_LARGE = 1
+    RATE = 2
+    BANDWIDTH = 3
+
+
+class Rejected(Exception):
+    """
+    The request is not admitted. The value is the size limit in bytes for
+    TOO_LARGE, the time to retry in milliseconds otherwise.
+    """
+
+    def __init__(self, reason: Reason, value: int = 0):
+        super().__init__(reason, value)
+        self.reason = reason
+        self.value = value
+
+    def __str__(self) -> str:
+        if self.reason == Reason.TOO_LARGE:
+            return f"payload is larger than {self.value} bytes"
+        what = "many requests" if self.reason == Reason.RATE else "much data"
+        return f"too {what}, retry in {self.value / 1000:.1f} s"
+
+
+class TokenBucket:
+    """
+    Tokens accumulate at rate per second up to capacity. A request may take
+    more tokens than there are, the bucket then stays empty, until the debt
+    is paid, so a cost larger than the capacity is still admitted once.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, need: float) -> float:
+        """Seconds until the bucket holds need tokens"""
+        return max(0.0, (need - self.tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class _Quota:
+    __slots__ = ("requests", "bytes")
+
+    def __init__(self, requests: Optional[TokenBucket],
+                 bytes: Optional[TokenBucket]):
+        self.requests = requests
+        self.bytes = bytes
+
+    def buckets(self):
+        return (b for b in (self.requests, self.bytes) if b is not None)
+
+
+class Admission:
+    """
+    Limits of the watcher, 0 disables each of them: max_payload in bytes,
+    rate of requests per second of a source with bursts up to burst
+    requests, bandwidth of a source in bytes per second with bursts up to
+    one second of it.
+    """
+
+    __slots__ = ("max_payload", "rate", "burst", "bandwidth", "__quotas")
+
+    def __init__(self, max_payload: int = 0, rate: float = 0, burst: int = 1,
+                 bandwidth: int = 0):
+        self.max_payload = max_payload
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.bandwidth = bandwidth
+        self.__quotas: Dict[int, _Quota] = {}
+
+    @property
+    def rate_limited(self) -> bool:
+        """Requests may be rejected for a rate limit, not only for size"""
+        return bool(self.rate or self.bandwidth)
+
+    def check_size(self, size: int) -> None:
+        if self.max_payload and size > self.max_payload:
+            raise Rejected(Reason.TOO_LARGE, self.max_payload)
+
+    def admit(self, source: int, size: int = 0) -> None:
+        """
+        Raises Rejected, unless the request of the source with a payload of
+        size bytes (0, if it is not known yet) may be handled now
+        """
+        self.check_size(size)
+        if not self.rate_limited:
+            return
+        quota = self.__quota(source)
+        now = monotonic()
+        for bucket in quota.buckets():
+            bucket.refill(now)
+        if quota.requests is not None and quota.requests.tokens < 1:
+            raise Rejected(Reason.RATE,
+                           _ms(quota.requests.wait_time(1)))
+        if quota.bytes is not None and quota.bytes.tokens < 0:
+            raise Rejected(Reason.BANDWIDTH, _ms(quota.bytes.wait_time(0)))
+        if quota.requests is not None:
+            quota.requests.tokens -= 1
+
+    def charge(self, source: int, size: int) -> None:
+        """Takes bytes, which the admitted request has transferred"""
+        if self.bandwidth:
+            self.__quota(source).bytes.tokens -= size
+
+    def __quota(self, source: int) -> _Quota:
+        quota = self.__quotas.get(source)
+        if quota is None:
+            if len(self.__quotas) >= _max_sources:
+                self.__prune()
+            quota = _Quota(
+                TokenBucket(self.rate, self.burst) if self.rate else None,
+                TokenBucket(self.bandwidth, self.bandwidth)
+                if self.bandwidth else None)
+            self.__quotas[source] = quota
+        return quota
+
+    def __prune(self) -> None:
+        """Drops sources with full buckets, they are as good as new"""
+        now = monotonic()
+        for source, quota in list(self.__quotas.items()):
+            for bucket in quota.buckets():
+                bucket.refill(now)
+            if all(bucket.full for bucket in quota.buckets()):
+                del self.__quotas[source]
+
+
+def _ms(seconds: float) -> int:
+    return max(1, round(seconds * 1000))
@@ -0,0 +1,166 @@
+from hashlib import blake2b
+from os import getpid, replace, scandir, stat, unlink, utime
+from pathlib import Path
+from struct import Struct
+from time import time
+from typing import Iterator, Optional, Tuple
+from zlib import crc32
+
+from .constants import CHUNKSDIR
+
+# Content-defined chunking, anchored on lines: a chunk ends after a line,
+# which checksum falls into one bucket of ANCHOR, once the chunk is at least
+# MIN_CHUNK long. So boundaries depend on the content near them only, and an
+# edit changes one or two chunks around it, while the rest of the payload
+# keeps the same chunks. Data without newlines is cut every MAX_CHUNK bytes.
+#
+# Chunks are stored in the clipboard directory by their hash, so both sides
+# share the store, and a payload is sent as a manifest: a list of (hash,
+# size) of its chunks. Only chunks missing in the store are written. The
+# manifest of a lazy copy, which the watcher holds, is pinned: its chunks are
+# not pruned, until another one replaces it. The store is used, while the
+# watcher announces it (--chunks) in the state record; the directory alone
+# does not enable it.
+
+MIN_CHUNK = 32 << 10
+MAX_CHUNK = 256 << 10
+ANCHOR = 256
+
+_ENTRY = Struct("<16sI")
+# chunks used recently are never pruned, a manifest may refer to them
+_PRUNE_GRACE_SEC = 60
+_PINNED = "pinned"
+
+
+def split(data: bytes) -> Iterator[Tuple[int, int]]:
+    """Yields (start, end) of the payload's chunks"""
+    view = memoryview(data)
+    size = len(data)
+    start = pos = 0
+    while pos < size:
+        eol = data.find(b'\n', pos, start + MAX_CHUNK)
+        if eol < 0:
+            end = min(start + MAX_CHUNK, size)
+            yield start, end
+            start = pos = end
+            continue
+        line, pos = pos, eol + 1
+        if pos - start >= MIN_CHUNK and crc32(view[line:pos]) % ANCHOR == 0:
+            yield start, pos
+            start = pos
+    if start < size:
+        yield start, size
+
+
+def payload_size(manifest: bytes) -> int:
+    """Size of the payload, which the manifest describes"""
+    return sum(size for _, size in _ENTRY.iter_unpack(manifest))
+
+
+def _digest(chunk) -> bytes:
+    return blake2b(chunk, digest_size=16).digest()
+
+
+class ChunkStore:
+    max_size = 512 << 20
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @classmethod
+    def open(cls, directory: Path, create: bool = False) \
+            -> Optional["ChunkStore"]:
+        """None, if the store's directory does not exist"""
+        path = Path(directory) / CHUNKSDIR
+        if create:
+            path.mkdir(exist_ok=True)
+        return cls(path) if path.is_dir() else None
+
+    def __file(self, digest: bytes) -> Path:
+        name = digest.hex()
+        return self.path / name[:2] / name
+
+    def put(self, data: bytes, report=None) -> Tuple[bytes, int]:
+        """
+        Stores payload's chunks, returns its manifest and the amount of
+        bytes actually written. `report(done, total)` is called after each
+        chunk.
+        """
+        view = memoryview(data)
+        manifest = []
+        written = 0
+        for start, end in split(data):
+            chunk = view[start:end]
+            digest = _digest(chunk)
+            manifest.append(_ENTRY.pack(digest, end - start))
+            file = self.__file(digest)
+            try:
+                # mark as recently used
+                utime(file)
+            except FileNotFoundError:
+                file.parent.mkdir(exist_ok=True)
+                tmp = file.with_name(f"{file.name}.{getpid()}.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(chunk)
+                replace(tmp, file)
+                written += end - start
+            if report:
+                report(end, len(data))
+        return b''.join(manifest), written
+
+    def get(self, manifest: bytes) -> bytes:
+        chunks = []
+        for digest, size in _ENTRY.iter_unpack(manifest):
+            try:
+                with open(self.__file(digest), "rb") as f:
+                    chunk = f.read()
+            except FileNotFoundError:
+                raise RuntimeError(f"Chunk {digest.hex()} is missing")
+            if len(chunk) != size or _digest(chunk) != digest:
+                raise RuntimeError(f"Chunk {digest.hex()} is corrupted")
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def pin(self, manifest: bytes) -> None:
+        """Keeps the manifest's chunks, until another manifest is pinned"""
+        file = self.path / _PINNED
+        tmp = file.with_name(f"{_PINNED}.{getpid()}.tmp")
+        tmp.write_bytes(manifest)
+        replace(tmp, file)
+
+    def __pinned(self) -> set:
+        try:
+            manifest = (self.path / _PINNED).read_bytes()
+        except FileNotFoundError:
+            return set()
+        return {digest.hex() for digest, _ in _ENTRY.iter_unpack(manifest)}
+
+    def prune(self) -> int:
+        """Removes least recently used chunks above max_size bytes"""
+        pinned = self.__pinned()
+        entries = []
+        total = 0
+        for fanout in scandir(self.path):
+            if not fanout.is_dir():
+                continue
+            for entry in scandir(fanout.path):
+                if entry.name in pinned:
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        removed = 0
+        keep_after = time() - _PRUNE_GRACE_SEC
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size or mtime > keep_after:
+                break
+            try:
+                # a writer may have reused the chunk since the scan
+                if stat(path).st_mtime > keep_after:
+                    continue
+                unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
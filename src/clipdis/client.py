@@ -0,0 +1,167 @@
+from asyncio import Lock, new_event_loop
+from os import environ
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+from .clip import copy_payload, paste_payload, wait_copied, request_source, \
+    chunk_store, shared_memory
+from .constants import CB_DIR_VAR_NAME, STATEFILE, ENCODING
+from .record import StateRecord
+from . import trace
+
+# Clipboard access for Python programs in the container. A session maps the
+# state record (and the shared memory and the chunk store, when the watcher
+# has them) once and sends requests with the same protocol as the clip tool,
+# so bulk clipboard work costs neither an interpreter nor a handshake per
+# operation.
+#
+# Requests are pipelined: a copy returns once it is published, so the caller
+# prepares the next value, while the watcher handles it, and only the next
+# copy waits for the watcher. A paste waits for the session's pending copy
+# first, so it never returns a value older than the session's own copy.
+#
+#     with Session() as clipboard:
+#         clipboard.copy_many(lines)
+#         value = clipboard.paste()
+#
+# Failures are reported with RuntimeWarning, as in the clip tool.
+
+Data = Union[str, bytes]
+
+
+def _directory(directory: Optional[Union[str, Path]]) -> Path:
+    if directory is not None:
+        return Path(directory)
+    if CB_DIR_VAR_NAME not in environ:
+        raise RuntimeWarning(f"{CB_DIR_VAR_NAME} variable is not set")
+    return Path(environ[CB_DIR_VAR_NAME])
+
+
+def _encode(data: Data) -> bytes:
+    return data.encode(ENCODING) if isinstance(data, str) else bytes(data)
+
+
+class AsyncSession:
+    """
+    Asyncio client. The directory is the clipboard volume, by default the
+    one in CLIPDIS_DIRECTORY.
+    """
+
+    def __init__(self, directory: Optional[Union[str, Path]] = None):
+        self.directory = _directory(directory)
+        self.record = StateRecord(self.directory / STATEFILE)
+        if self.record.tracing:
+            trace.enable(self.directory, trace.Side.CLIP)
+        self.record.source = request_source()
+        self.shm = shared_memory(self.record)
+        self.store = chunk_store(self.record)
+        # lane locks do not exclude requests of the same process
+        self.__copy_lock = Lock()
+        self.__paste_lock = Lock()
+        self.__copied = False
+
+    async def copy(self, data: Data) -> None:
+        async with self.__copy_lock:
+            await copy_payload(self.record, _encode(data), self.store)
+            self.__copied = True
+
+    async def copy_many(self, values: Iterable[Data]) -> None:
+        """Copies values one after another, waits for the last one"""
+        for data in values:
+            await self.copy(data)
+        await self.flush()
+
+    async def paste(self) -> str:
+        await self.flush()
+        async with self.__paste_lock:
+            data = await paste_payload(self.record)
+        return data.decode(ENCODING)
+
+    async def paste_many(self, count: int) -> List[str]:
+        """Pastes count times, e.g. to sample a changing clipboard"""
+        return [await self.paste() for _ in range(count)]
+
+    async def flush(self) -> None:
+        """Waits for the watcher to handle the session's pending copy"""
+        async with self.__copy_lock:
+            if self.__copied:
+                await wait_copied(self.record)
+                self.__copied = False
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            if self.shm is not None:
+                self.shm.close()
+            self.record.close()
+
+    async def __aenter__(self) -> "AsyncSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+class Session:
+    """Blocking client, runs an AsyncSession in its own event loop"""
+
+    def __init__(self, directory: Optional[Union[str, Path]] = None):
+        self.__loop = new_event_loop()
+        try:
+            self.__session = AsyncSession(directory)
+        except BaseException:
+            self.__loop.close()
+            raise
+
+    def __run(self, co):
+        return self.__loop.run_until_complete(co)
+
+    def copy(self, data: Data) -> None:
+        self.__run(self.__session.copy(data))
+
+    def copy_many(self, values: Iterable[Data]) -> None:
+        self.__run(self.__session.copy_many(values))
+
+    def paste(self) -> str:
+        return self.__run(self.__session.paste())
+
+    def paste_many(self, count: int) -> List[str]:
+        return self.__run(self.__session.paste_many(count))
+
+    def flush(self) -> None:
+        self.__run(self.__session.flush())
+
+    def close(self) -> None:
+        try:
+            self.__run(self.__session.close())
+        finally:
+            self.__loop.close()
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def copy(data: Data, directory: Optional[Union[str, Path]] = None) -> None:
+    with Session(directory) as session:
+        session.copy(data)
+
+
+def paste(directory: Optional[Union[str, Path]] = None) -> str:
+    with Session(directory) as session:
+        return session.paste()
+
+
+def copy_many(values: Iterable[Data],
+              directory: Optional[Union[str, Path]] = None) -> None:
+    with Session(directory) as session:
+        session.copy_many(values)
+
+
+def paste_many(count: int,
+               directory: Optional[Union[str, Path]] = None) -> List[str]:
+    with Session(directory) as session:
+        return session.paste_many(count)
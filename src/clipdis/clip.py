@@ -1,19 +1,42 @@
-from typing import Sequence
+from typing import Optional, Sequence
 from sys import stdin, stdout, argv
 from pathlib import Path
-from os import stat
-from asyncio import sleep
+from asyncio import Queue, TimeoutError, get_event_loop, \
+    run_coroutine_threadsafe, sleep, wait_for
+from time import monotonic
 from argparse import ArgumentParser, Namespace
-from os import environ
-from .constants import CB_DIR_VAR_NAME
+from contextlib import asynccontextmanager
+from functools import partial
+from os import environ, getsid, read
+from threading import Thread
+from zlib import crc32
+from .constants import CB_DIR_VAR_NAME, SOURCE_VAR_NAME
 
-from .common import run_in_executor, eopen, State, FileWatcher
-from .constants import STATEFILE, DATAFILE, ENCODING
+from .common import run_in_executor, State, poll_interval
+from .constants import STATEFILE, ENCODING
+from .record import StateRecord, Lane, read_payload, send_payload, \
+    FLAG_START
+from .follow import APPEND_HEADER, utf8_prefix
+from .admission import Reason, Rejected
+from .chunks import ChunkStore
+from .shm import SharedMemory
+from . import trace
+from .trace import Event, emit, state_code
 
 
-_wait_refresh_sec = 0.1
+_wait_refresh_sec = poll_interval(0.01)
+# how long the watcher may show no sign of life (heartbeat or progress)
 _wait_max_time_sec = 1
-_wait_max_try = _wait_max_time_sec // _wait_refresh_sec
+
+# follow mode sends appended data, when either limit is reached
+_follow_batch_sec = 0.2
+_follow_batch_size = 256 << 10
+_follow_read_size = 64 << 10
+_follow_queue_size = 16
+
+# subscribers renew the lease every _watch_renew_sec
+_watch_lease_sec = 2
+_watch_renew_sec = 0.5
 
 
 def _is_copy(name: str, ns: Namespace, args: Sequence[str]) -> bool:
@@ -42,60 +65,314 @@ def _is_paste(name: str, ns: Namespace, args: Sequence[str]) -> bool:
         return False
 
 
-async def _copy(datafile: Path, statefile: Path) -> None:
-    with eopen(datafile, "wt") as df:
-        data = await run_in_executor(stdin.buffer.read)
-        df.write(data.decode(encoding=ENCODING, errors="strict"))
-        with eopen(statefile, "wt") as sf:
-            sf.write(State.COPY.value)
+def request_source() -> int:
+    """
+    Source of this process' requests for the watcher's rate limits: the
+    CLIPDIS_SOURCE name, if it is set, the session ID otherwise, so the
+    commands of one terminal or script share their limits.
+    """
+    name = environ.get(SOURCE_VAR_NAME)
+    return crc32(name.encode()) if name else getsid(0)
 
 
-def _paste_callback(datafile: Path, statefile: Path) -> None:
-    with eopen(statefile, "rt") as sf:
-        state = sf.read()
-        if State.DONE.value not in state:
-            raise RuntimeWarning(
-                "State file is not in proper condition, must be DONE")
-    with eopen(datafile, "rt") as df:
-        data = df.read()
-        stdout.write(data)
-        stdout.flush()
+def chunk_store(record: StateRecord) -> Optional[ChunkStore]:
+    """The chunk store, if the watcher announces it (--chunks)"""
+    if not record.chunking:
+        return None
+    return ChunkStore.open(record.path.parent)
 
 
-async def _wait_for_done(statefile: Path) -> bool:
-    stamp = 0
-    count = 0
-    while True:
-        if count == _wait_max_try:
+def shared_memory(record: StateRecord) -> Optional[SharedMemory]:
+    """
+    The watcher's shared memory attached to the record, if the watcher
+    announces it (--shm)
+    """
+    if not record.sharing:
+        return None
+    shm = SharedMemory.open(record.path.parent)
+    if shm is not None:
+        shm.attach(record)
+    return shm
+
+
+def _check_size(record: StateRecord, data: bytes, operation: str) -> None:
+    """Rejects a payload above the watcher's limit before sending it"""
+    limit = record.max_payload
+    if limit and len(data) > limit:
+        raise RuntimeWarning(f"Watcher rejected the {operation}: "
+                             f"{Rejected(Reason.TOO_LARGE, limit)}")
+
+
+def _check_answer(lane: Lane, operation: str) -> None:
+    fields = lane.read()
+    if fields.status == State.REJECTED:
+        reason = Rejected(Reason(fields.flags), fields.length)
+        raise RuntimeWarning(f"Watcher rejected the {operation}: {reason}")
+    if fields.status != State.DONE:
+        raise RuntimeWarning(f"Watcher failed to {operation}")
+
+
+async def _answered(lane: Lane, operation: str) -> None:
+    """
+    Waits for the answer to a copy, when the watcher may reject it for a
+    rate limit; otherwise the copy returns once it is published.
+    """
+    if not lane.record.rate_limited:
+        return
+    if not await _wait_for_ack(lane):
+        raise RuntimeWarning("Watcher stopped responding")
+    _check_answer(lane, operation)
+
+
+@asynccontextmanager
+async def _locked(lane: Lane):
+    """
+    Holds the lane for one request. The previous request must be handled
+    by the watcher first, otherwise its payload will be overwritten. If the
+    watcher does not answer, the previous request is abandoned. A request,
+    which is published, but given up on (Ctrl-C, timeout, error), is
+    cancelled, so the watcher drops its work.
+    """
+    await run_in_executor(lane.lock)
+    try:
+        await _wait_for_ack(lane)
+        published = lane.seq
+        try:
+            yield lane
+        except BaseException:
+            if lane.seq != published:
+                lane.cancel(lane.seq)
+                emit(Event.CANCEL, state_code(lane.read().op), lane.seq)
+            raise
+    finally:
+        lane.unlock()
+
+
+async def _wait_for_ack(lane: Lane) -> bool:
+    """
+    Waits for the watcher to handle the pending request. The deadline is
+    extended on every heartbeat or progress report, so large payloads may
+    take as long as they need, while a dead watcher is detected quickly.
+    """
+    liveness = lane.liveness()
+    deadline = monotonic() + _wait_max_time_sec
+    while lane.pending:
+        current = lane.liveness()
+        if current != liveness:
+            liveness = current
+            deadline = monotonic() + _wait_max_time_sec
+        elif monotonic() > deadline:
             return False
-        count += 1
         await sleep(_wait_refresh_sec)
-        newstamp = stat(statefile).st_mtime
-        if newstamp == stamp:
+    return True
+
+
+async def copy_payload(record: StateRecord, data: bytes,
+                       store: Optional[ChunkStore]) -> None:
+    """
+    Sends a COPY request. Returns, once the request is published; the next
+    request on the lane waits for the watcher to handle it.
+    """
+    emit(Event.OP_START, state_code(State.COPY))
+    data.decode(encoding=ENCODING, errors="strict")
+    _check_size(record, data, "copy")
+    async with _locked(record.lane(State.COPY)) as lane:
+        try:
+            await run_in_executor(send_payload, lane, data,
+                                  partial(lane.request, State.COPY), store)
+        except RuntimeError as err:
+            raise RuntimeWarning(f"Copy failed: {err}")
+        emit(Event.STATE_WRITE, state_code(State.COPY), lane.seq)
+        await _answered(lane, "copy")
+    emit(Event.OP_END, state_code(State.COPY), len(data))
+
+
+async def wait_copied(record: StateRecord) -> None:
+    """Waits for the watcher to handle the last COPY request"""
+    if not await _wait_for_ack(record.lane(State.COPY)):
+        raise RuntimeWarning("Watcher stopped responding")
+
+
+async def _copy(record: StateRecord, store: Optional[ChunkStore]) -> None:
+    data = await run_in_executor(stdin.buffer.read)
+    await copy_payload(record, data, store)
+
+
+def _read_stream(queue: Queue, loop) -> None:
+    """
+    Feeds stdin chunks into the queue, ending with b''. Blocks, while the
+    queue is full, so a slow watcher slows the writer down.
+    """
+    fd = stdin.buffer.fileno()
+    while True:
+        chunk = read(fd, _follow_read_size)
+        run_coroutine_threadsafe(queue.put(chunk), loop).result()
+        if not chunk:
+            return
+
+
+async def _follow(record: StateRecord, store: Optional[ChunkStore],
+                  window: int) -> None:
+    """
+    Sends stdin to the watcher as it grows: appended data is batched by time
+    and size, the watcher keeps the last window bytes of the stream.
+    """
+    limit = record.max_payload
+    if limit and window > limit:
+        raise RuntimeWarning(f"Watcher rejected the copy: window is "
+                             f"larger than {limit} bytes")
+    queue = Queue(_follow_queue_size)
+    # not an executor thread: it must not keep the process on errors
+    Thread(target=_read_stream, args=(queue, get_event_loop()),
+           daemon=True).start()
+    batch = bytearray()
+    deadline = None
+    start = True
+    eof = False
+    while not eof:
+        timeout = None if deadline is None else \
+            max(0, deadline - monotonic())
+        try:
+            chunk = await wait_for(queue.get(), timeout)
+        except TimeoutError:
+            chunk = None
+        if chunk:
+            batch += chunk
+            if deadline is None:
+                deadline = monotonic() + _follow_batch_sec
+        eof = chunk == b''
+        if not batch or not eof and len(batch) < _follow_batch_size and \
+                monotonic() < deadline:
             continue
-        stamp = newstamp
-        with eopen(statefile, "rt") as sf:
-            if State.DONE.value in sf.read():
-                return True
-
-
-async def _paste(datafile: Path, statefile: Path) -> None:
-    sf_watcher = FileWatcher(statefile, _paste_callback, datafile, statefile)
-    with eopen(statefile, "wt") as sf:
-        sf.write(State.PASTE.value)
-    done = await _wait_for_done(statefile)
-    if not done:
-        return
-    await sf_watcher.async_look()
+        size = len(batch) if eof else utf8_prefix(batch)
+        data = bytes(batch[:size])
+        del batch[:size]
+        deadline = monotonic() + _follow_batch_sec if batch else None
+        if not data:
+            continue
+        data.decode(encoding=ENCODING, errors="strict")
+        await _append(record, store, data, window, start)
+        start = False
+    lane = record.lane(State.COPY)
+    if not await _wait_for_ack(lane):
+        raise RuntimeWarning("Watcher stopped responding")
+
+
+async def _append(record: StateRecord, store: Optional[ChunkStore],
+                  data: bytes, window: int, start: bool) -> None:
+    payload = APPEND_HEADER.pack(window) + data
+    _check_size(record, payload, "copy")
+
+    def publish(flags: int, crc: int, length: int) -> None:
+        lane.request(State.APPEND, flags | (FLAG_START if start else 0), crc,
+                     length)
+
+    async with _locked(record.lane(State.APPEND)) as lane:
+        if lane.pending:
+            raise RuntimeWarning("Watcher stopped responding")
+        try:
+            await run_in_executor(send_payload, lane, payload, publish, store)
+        except RuntimeError as err:
+            raise RuntimeWarning(f"Copy failed: {err}")
+        emit(Event.STATE_WRITE, state_code(State.APPEND), lane.seq)
+        await _answered(lane, "copy")
+
+
+async def paste_payload(record: StateRecord) -> bytes:
+    """Sends a PASTE request and returns the host clipboard value"""
+    emit(Event.OP_START, state_code(State.PASTE))
+    async with _locked(record.lane(State.PASTE)) as lane:
+        seq = lane.request(State.PASTE)
+        emit(Event.STATE_WRITE, state_code(State.PASTE), seq)
+        if not await _wait_for_ack(lane):
+            emit(Event.TIMEOUT, state_code(State.PASTE))
+            emit(Event.OP_END, state_code(State.PASTE))
+            fields = lane.read()
+            raise RuntimeWarning(
+                f"Watcher stopped responding after {_wait_max_time_sec} s, "
+                f"received {fields.progress} of {fields.total or '?'} bytes")
+        _check_answer(lane, "paste")
+        try:
+            data = await run_in_executor(read_payload, lane)
+        except RuntimeError as err:
+            raise RuntimeWarning(f"Paste failed: {err}")
+    emit(Event.OP_END, state_code(State.PASTE), len(data))
+    return data
+
+
+async def _paste(record: StateRecord) -> None:
+    data = await paste_payload(record)
+    stdout.buffer.write(data)
+    stdout.flush()
+
+
+async def _watch(record: StateRecord, notify: bool, separator: bytes) -> None:
+    """
+    Writes every new host clipboard value (or, with notify, its generation
+    number), followed by the separator, until the watcher goes away.
+    """
+    broadcast = record.broadcast
+    # a value published before anybody subscribed may be stale, it is skipped,
+    # until the watcher publishes the current one anew
+    stale = None if broadcast.subscribed() else broadcast.generation
+    last = None
+    printed = None
+    renewed = 0
+    beat = broadcast.beat
+    deadline = monotonic() + _wait_max_time_sec + _watch_lease_sec
+    while True:
+        if monotonic() - renewed > _watch_renew_sec:
+            broadcast.subscribe(_watch_lease_sec)
+            renewed = monotonic()
+        if broadcast.beat != beat:
+            beat = broadcast.beat
+            deadline = monotonic() + _wait_max_time_sec
+        elif monotonic() > deadline:
+            raise RuntimeWarning("Watcher stopped responding")
+        if broadcast.generation not in (last, stale):
+            last, data = broadcast.read()
+            if data is not None:
+                value = (len(data), crc32(data))
+                if value != printed:
+                    printed = value
+                    emit(Event.STATE_READ, state_code(State.PASTE), len(data))
+                    out = f"{last}".encode() if notify else data
+                    stdout.buffer.write(out + separator)
+                    stdout.flush()
+            else:
+                # replaced while read, read the new one
+                last = None
+        await sleep(_wait_refresh_sec)
+
+
+async def _halt(record: StateRecord) -> None:
+    async with _locked(record.lane(State.HALT)) as lane:
+        seq = lane.request(State.HALT)
+        emit(Event.STATE_WRITE, state_code(State.HALT), seq)
 
 
 async def clipboard_tool() -> None:
     parser = ArgumentParser()
     binname = Path(argv[0]).stem
+    parser.add_argument("--follow", action="store_true",
+                        help="Copy: send the input as it grows, until EOF")
+    parser.add_argument("--window", type=int, default=1 << 20,
+                        help="Follow: keep only the last bytes of the input "
+                        "in the clipboard; by default: 1048576")
+    parser.add_argument("--watch", action="store_true",
+                        help="Paste: print every new clipboard value, until "
+                        "interrupted")
+    parser.add_argument("--notify", action="store_true",
+                        help="Watch: print only generation numbers of new "
+                        "values")
+    parser.add_argument("-0", "--null", action="store_true",
+                        help="Watch: end values with NUL instead of newline")
 
     if binname == "run_clip":
         parser.add_argument("--copy", action="store_true")
         parser.add_argument("--paste", action="store_true")
+        parser.add_argument("--halt", action="store_true",
+                            help="Ask the watcher to exit")
         parser.add_argument("--directory", type=str, required=True)
 
         ns = parser.parse_args()
@@ -109,29 +386,27 @@ async def clipboard_tool() -> None:
             raise RuntimeWarning(f"{CB_DIR_VAR_NAME} variable is not set")
         directory = environ[CB_DIR_VAR_NAME]
 
-    datafile, statefile = _ensure_files(directory)
-
-    if not datafile.exists():
-        datafile.touch()
-    if not statefile.exists():
-        statefile.touch()
+    record = StateRecord(Path(directory) / STATEFILE)
+    if record.tracing:
+        trace.enable(directory, trace.Side.CLIP)
+    record.source = request_source()
+    shared_memory(record)
 
-    if _is_copy(binname, ns, args):
-        await _copy(datafile, statefile)
+    if binname == "run_clip" and ns.halt:
+        await _halt(record)
+    elif _is_copy(binname, ns, args) and ns.follow:
+        await _follow(record, chunk_store(record), ns.window)
+    elif _is_copy(binname, ns, args):
+        await _copy(record, chunk_store(record))
+    elif _is_paste(binname, ns, args) and ns.watch:
+        try:
+            await _watch(record, ns.notify, b"\0" if ns.null else b"\n")
+        except BrokenPipeError:
+            # the reader is gone, e.g. `p --watch | head -1`
+            pass
     elif _is_paste(binname, ns, args):
-        await _paste(datafile, statefile)
+        await _paste(record)
     else:
         parser.print_usage()
         raise RuntimeWarning(f"Unrecognized program name: {binname}")
 
-
-def _ensure_files(directory: Path) -> tuple[Path, Path]:
-    datafile = directory / DATAFILE
-    statefile = directory / STATEFILE
-
-    if not datafile.exists():
-        datafile.touch()
-    if not statefile.exists():
-        statefile.touch()
-
-    return (datafile, statefile)
@@ -1,7 +1,14 @@
 from pathlib import Path
 
 CB_DIR_VAR_NAME = "CLIPDIS_DIRECTORY"
+POLL_VAR_NAME = "CLIPDIS_POLL_INTERVAL"
+SOURCE_VAR_NAME = "CLIPDIS_SOURCE"
 
 ENCODING = "utf-8"
 STATEFILE = Path(".state")
 DATAFILE = Path(".data")
+TRACEFILE = Path(".trace")
+CHUNKSDIR = Path(".chunks")
+PROMISEFILE = Path(".promise")
+SHMFILE = Path(".shm")
+PROFILEFILE = Path(".profile")
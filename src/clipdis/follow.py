@@ -0,0 +1,82 @@
+from asyncio import Task, create_task, current_task, sleep, wait
+from struct import Struct
+from typing import Awaitable, Callable, Optional
+
+# Follow mode: `c --follow` sends a growing stream in APPEND requests, each
+# carrying the window size and the bytes appended since the previous one. The
+# watcher keeps the last window bytes of the stream and syncs them to the
+# host clipboard at most once per sync interval, so a fast stream costs one
+# host clipboard update per interval instead of one per append. A copy
+# replaces the stream, so it drops the sync, which is still pending.
+
+APPEND_HEADER = Struct("<Q")
+
+
+def utf8_prefix(data: bytes) -> int:
+    """Length of data without an incomplete UTF-8 sequence at its end"""
+    size = len(data)
+    for i in range(1, min(4, size) + 1):
+        b = data[size - i]
+        if b & 0xc0 != 0x80:
+            need = 1 if b < 0x80 else 2 if b < 0xe0 else 3 if b < 0xf0 else 4
+            return size if need <= i else size - i
+    return size
+
+
+class Follow:
+    sync_interval_in_seconds = 0.5
+    __slots__ = ("value", "generation", "__sync_task", "__syncing")
+
+    def __init__(self):
+        self.value = bytearray()
+        self.generation = 0
+        self.__sync_task: Optional[Task] = None
+        self.__syncing = False
+
+    def append(self, data: bytes, window: int, start: bool) -> None:
+        """Appends data to the stream, keeping only the last window bytes"""
+        if start:
+            self.value.clear()
+        self.value += data
+        excess = len(self.value) - window
+        if excess > 0:
+            # do not cut a UTF-8 sequence
+            while excess < len(self.value) and \
+                    self.value[excess] & 0xc0 == 0x80:
+                excess += 1
+            del self.value[:excess]
+        self.generation += 1
+
+    def schedule_sync(self, sync: Callable[[bytes], Awaitable[None]]) -> None:
+        """Syncs after the interval; appends meanwhile join the same sync"""
+        if self.__sync_task is None or self.__sync_task.done():
+            self.__sync_task = create_task(self.__sync_later(sync))
+
+    async def cancel_sync(self) -> None:
+        """
+        Drops the pending sync. A sync in progress is waited for: its host
+        clipboard call runs in a thread, which cancelling does not stop.
+        """
+        task = self.__sync_task
+        self.__sync_task = None
+        if task is None or task.done():
+            return
+        if self.__syncing:
+            # the task is not current anymore, it ends after this sync
+            await wait({task})
+        else:
+            task.cancel()
+
+    async def __sync_later(self,
+                           sync: Callable[[bytes], Awaitable[None]]) -> None:
+        synced = None
+        while synced != self.generation:
+            await sleep(self.sync_interval_in_seconds)
+            synced = self.generation
+            self.__syncing = True
+            try:
+                await sync(bytes(self.value))
+            finally:
+                self.__syncing = False
+            if self.__sync_task is not current_task():
+                return
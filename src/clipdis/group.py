@@ -0,0 +1,142 @@
+import logging
+
+from asyncio import Task, create_task, sleep
+from enum import Enum
+from os import getpid, replace, unlink
+from pathlib import Path
+from typing import Callable, Optional
+from zlib import crc32
+
+from .common import run_in_executor
+
+# Shared clipboard of a group of containers. Watchers of the group share the
+# group directory; a copy in any container is stored there as the group's
+# latest value, and pastes in all containers are served from it directly,
+# without the host clipboard round trip.
+#
+# The host clipboard is either updated lazily, when no copies came for a
+# while, or never. Until the latest value is synced to the host, it is marked
+# pending; after that the host clipboard is the source of truth again, so
+# values copied by host applications reach the containers. A member syncs
+# only its own copy, and not when the host clipboard changed since the copy:
+# the host application's value is newer then. The host clipboard is read for
+# that after the copy is published, so other members see the copy without
+# waiting for the host.
+
+_LATEST = "latest"
+_PENDING = "pending"
+
+
+class HostSync(Enum):
+    LAZY = "lazy"
+    NONE = "none"
+
+
+class ClipboardGroup:
+    sync_delay_in_seconds = 2
+
+    def __init__(self, path: Path, member: str, sync: HostSync):
+        self.path = Path(path)
+        self.member = member
+        self.sync = sync
+        self.__counter = 0
+        self.__token: Optional[bytes] = None
+        # checksum of the host clipboard, when the token was published
+        self.__host: Optional[int] = None
+        self.__sync_task: Optional[Task] = None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __write(self, name: str, data: bytes) -> None:
+        file = self.path / name
+        tmp = file.with_name(f".{name}.{getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        replace(tmp, file)
+
+    def __read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.path / name, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def publish(self, data: bytes) -> None:
+        """Makes data the group's latest value"""
+        self.__counter += 1
+        token = f"{self.member}:{getpid()}:{self.__counter}".encode()
+        self.__write(_LATEST, data)
+        self.__write(_PENDING, token)
+        self.__token = token
+        self.__host = None
+
+    def latest(self) -> Optional[bytes]:
+        """Group's latest value, if pastes must be served from it"""
+        if self.sync == HostSync.LAZY and self.__read(_PENDING) is None:
+            return None
+        return self.__read(_LATEST)
+
+    def schedule_sync(self, host_copy: Callable[[bytes], None],
+                      host_paste: Callable[[], bytes]) -> None:
+        """
+        Syncs the value published last, unless a new one comes soon. The host
+        clipboard is read right away, its later changes are kept.
+        """
+        if self.sync == HostSync.NONE:
+            return
+        if self.__sync_task is not None:
+            self.__sync_task.cancel()
+        self.__sync_task = create_task(
+            self.__sync_later(self.__token, host_copy, host_paste))
+
+    async def __sync_later(self, token: bytes,
+                           host_copy: Callable[[bytes], None],
+                           host_paste: Callable[[], bytes]) -> None:
+        host = await run_in_executor(_checksum, host_paste)
+        if token == self.__token:
+            self.__host = host
+        await sleep(self.sync_delay_in_seconds)
+        await run_in_executor(self.flush, token, host_copy, host_paste)
+
+    def flush(self, token: Optional[bytes],
+              host_copy: Callable[[bytes], None],
+              host_paste: Callable[[], bytes]) -> None:
+        """
+        Copies the latest value to the host clipboard, if it is still the one
+        identified by token, the member's own copy, and the host clipboard
+        has not changed since it was published
+        """
+        pending = self.__read(_PENDING)
+        if token is None or pending != token:
+            return
+        host = _checksum(host_paste) if self.__host is not None else None
+        if host is not None and host != self.__host:
+            logging.info("Host clipboard changed, group value is not synced")
+        else:
+            data = self.__read(_LATEST)
+            if data is None:
+                return
+            host_copy(data)
+            logging.info("Group value synced to the host clipboard")
+        # a newer copy may have arrived meanwhile, it stays pending
+        if self.__read(_PENDING) == pending:
+            try:
+                unlink(self.path / _PENDING)
+            except FileNotFoundError:
+                pass
+
+    def close(self, host_copy: Callable[[bytes], None],
+              host_paste: Callable[[], bytes]) -> None:
+        if self.__sync_task is not None:
+            self.__sync_task.cancel()
+        if self.sync == HostSync.LAZY:
+            # do not lose the own value, which was not synced yet
+            self.flush(self.__token, host_copy, host_paste)
+
+
+def _checksum(host_paste: Callable[[], bytes]) -> Optional[int]:
+    try:
+        return crc32(host_paste())
+    except Exception as err:
+        logging.warning(f"Host clipboard is not read: {err}")
+        return None
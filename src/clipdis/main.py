@@ -1,7 +1,6 @@
 from traceback import format_exc
+from sys import stderr
 
-from .clip import clipboard_tool
-from .watcher import watcher
 from enum import Enum
 
 
@@ -12,13 +11,18 @@ class ClipdisType(Enum):
 
 async def main(type: ClipdisType) -> int:
     try:
+        # each side imports only its own modules: the watcher lives long, the
+        # clip tool starts often
         if type is ClipdisType.WATCHER:
+            from .watcher import watcher
             await watcher()
         else:
+            from .clip import clipboard_tool
             await clipboard_tool()
         return 0
     except RuntimeWarning as err:
-        print(f"Warning: {err}")
+        print(f"Warning: {err}", file=stderr)
+        return 1
     except Exception as err:
         print(f"Error: {err}")
         trace: str = format_exc(chain=False)
@@ -0,0 +1,185 @@
+import logging
+
+from asyncio import all_tasks, get_event_loop, sleep
+from collections import Counter
+from io import StringIO
+from linecache import getline
+from os import getpid
+from os.path import basename
+from pathlib import Path
+from signal import SIGUSR1
+from sys import _current_frames
+from threading import Event, Thread, get_ident
+from time import monotonic, strftime
+from typing import Optional
+
+# On-demand profiling of the running watcher. A session is started and
+# stopped by SIGUSR1 (`kill -USR1 <pid>`, the PID is in `.lock`) or by
+# creating and removing the `.profile` control file in the clipboard
+# directory. While it runs, the event loop thread is profiled with cProfile,
+# and a sampler thread records stacks of busy threads, so time spent in
+# executor threads (host clipboard calls, payload I/O) is seen as well. When
+# the session stops, the report is written next to the log file (or into the
+# clipboard directory without one): stacks of all asyncio tasks, the sampled
+# hot spots and the cProfile statistics. cProfile and pstats are imported
+# by the first session, so an idle hook costs the watcher no memory.
+
+_sample_interval_sec = 0.01
+_control_refresh_sec = 1
+_MAX_DEPTH = 64
+_TOP = 30
+# innermost frames of threads waiting for work: (file name, function)
+_IDLE = {("selectors.py", "select"), ("thread.py", "_worker")}
+
+
+class Profiler:
+    __slots__ = ("report_dir", "__profile", "__samples", "__idle", "__stop",
+                 "__sampler", "__started")
+
+    def __init__(self, report_dir: Path):
+        self.report_dir = Path(report_dir)
+        self.__profile = None
+        self.__samples = Counter()
+        self.__idle = 0
+        self.__stop = Event()
+        self.__sampler: Optional[Thread] = None
+        self.__started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.__profile is not None
+
+    def install(self) -> None:
+        """Toggles profiling on SIGUSR1; call from the event loop thread"""
+        get_event_loop().add_signal_handler(SIGUSR1, self.toggle)
+
+    def toggle(self) -> None:
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.__samples.clear()
+        self.__idle = 0
+        self.__stop.clear()
+        self.__sampler = Thread(target=self.__sample, args=(get_ident(),),
+                                daemon=True)
+        self.__sampler.start()
+        self.__started = monotonic()
+        from cProfile import Profile
+        self.__profile = Profile()
+        self.__profile.enable()
+        logging.info("Profiling started")
+
+    def stop(self) -> Optional[Path]:
+        """Stops the session and writes the report, returns its path"""
+        if not self.running:
+            return None
+        self.__profile.disable()
+        self.__stop.set()
+        self.__sampler.join()
+        report = self.__report()
+        self.__profile = None
+        self.__sampler = None
+        path = self.report_dir / \
+            f"clipdis-profile-{getpid()}-{strftime('%Y%m%d-%H%M%S')}.txt"
+        try:
+            path.write_text(report)
+        except OSError as err:
+            logging.error(f"Profile is not written: {err}")
+            return None
+        logging.info(f"Profile written to {path}")
+        return path
+
+    async def watch_control(self, path: Path) -> None:
+        """Starts profiling, when the file appears, stops, when it is gone"""
+        present = path.exists()
+        while True:
+            await sleep(_control_refresh_sec)
+            if path.exists() == present:
+                continue
+            present = not present
+            if present:
+                self.start()
+            else:
+                self.stop()
+
+    def __sample(self, loop_thread: int) -> None:
+        own = get_ident()
+        while not self.__stop.wait(_sample_interval_sec):
+            for ident, frame in _current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < _MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_filename, frame.f_lineno,
+                                  code.co_name))
+                    frame = frame.f_back
+                if stack and (basename(stack[0][0]), stack[0][2]) in _IDLE:
+                    self.__idle += 1
+                else:
+                    self.__samples[(ident == loop_thread, tuple(stack))] += 1
+
+    def __report(self) -> str:
+        out = StringIO()
+        total = sum(self.__samples.values())
+        out.write(f"clipdis watcher {getpid()}, profiled for "
+                  f"{monotonic() - self.__started:.1f} s, "
+                  f"{total} busy and {self.__idle} idle samples\n")
+
+        tasks = all_tasks()
+        out.write(f"\nTasks ({len(tasks)})\n")
+        for task in tasks:
+            out.write(f"\n  {task!r}\n")
+            for frame in _task_stack(task):
+                out.write(f"    {_location(*frame)}\n")
+
+        functions = Counter()
+        for (_, stack), count in self.__samples.items():
+            if stack:
+                functions[stack[0]] += count
+        out.write("\nSampled functions, busy threads (self time)\n")
+        for frame, count in functions.most_common(_TOP):
+            out.write(f"  {count:6} {count / total:6.1%}  "
+                      f"{_location(*frame)}\n")
+
+        out.write("\nSampled stacks, busy threads (innermost first)\n")
+        for (in_loop, stack), count in self.__samples.most_common(_TOP):
+            thread = "event loop" if in_loop else "other thread"
+            out.write(f"\n  {count:6} {count / total:6.1%}  {thread}\n")
+            for frame in stack:
+                out.write(f"    {_location(*frame)}\n")
+
+        out.write("\nEvent loop thread (cProfile, by cumulative time)\n")
+        from pstats import Stats
+        stats = Stats(self.__profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(_TOP)
+        return out.getvalue()
+
+
+def _task_stack(task) -> list:
+    """
+    Frames of a task, innermost first. Follows the chain of awaited
+    coroutines, which Task.get_stack does not.
+    """
+    frames = []
+    coro = task.get_coro() if hasattr(task, "get_coro") else task._coro
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or \
+            getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append((frame.f_code.co_filename, frame.f_lineno,
+                       frame.f_code.co_name))
+        coro = getattr(coro, "cr_await", None) or \
+            getattr(coro, "gi_yieldfrom", None)
+    return frames[::-1]
+
+
+def _location(filename: str, lineno: int, name: str) -> str:
+    line = getline(filename, lineno).strip()
+    return f"{name} ({filename}:{lineno})" + (f": {line}" if line else "")
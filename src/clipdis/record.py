@@ -0,0 +1,527 @@
+from asyncio import sleep
+from fcntl import lockf, LOCK_EX, LOCK_UN
+from mmap import mmap
+from os import open as os_open, close, fstat, ftruncate, getpid, replace, \
+    O_RDWR, O_CREAT
+from pathlib import Path
+from struct import Struct
+from time import time
+from typing import Callable, NamedTuple, Optional, Tuple
+from functools import partial
+from zlib import crc32
+from inspect import iscoroutinefunction
+
+from .chunks import ChunkStore, payload_size as _manifest_size
+from .common import State, poll_interval
+from .constants import DATAFILE
+from .trace import Event, emit, state_code
+
+# `.state` is a fixed-size binary record, which both sides map into memory:
+#
+#     header | copy lane | paste lane
+#
+# Each lane holds the current request of its direction: op, status, flags,
+# payload checksum, payload length, progress of the request (heartbeat
+# counter, expected and written bytes), sequence number of the last request
+# (written by the clip tool) and sequence number of the last handled request
+# (written by the watcher), followed by the inline payload area. A request is
+# published by writing all its fields and then the sequence number; a
+# response - by writing all its fields and then the acknowledged sequence
+# number. So polling is just a memory read. While the watcher handles a
+# request, it bumps the heartbeat and reports progress, so the client may
+# wait as long as the watcher is alive and give up early when it is not.
+#
+# Payloads, which fit into the inline area, are stored in the lane itself,
+# others are stored in the lane's data slot (`.data.copy`, `.data.paste`).
+# A slot is written into a temporary file and renamed, so a reader always
+# gets a complete payload. Copy uploads and paste downloads use different
+# lanes and slots and may proceed at the same time. When the chunk store is
+# enabled, large payloads are sent as a manifest of their chunks instead.
+# When the shared memory is attached (see shm.py), large payloads are
+# streamed through the lane's ring buffer instead of the slot.
+#
+# The header also holds the broadcast block for subscribers (`p --watch`):
+# generation, length and checksum of the host clipboard value, which the
+# watcher published last into `.data.watch`, the watcher's heartbeat and the
+# subscription lease. Subscribers renew the lease, and while it holds, the
+# watcher watches the host clipboard and publishes every new value.
+#
+# The sequence number is the request's ID. A client, which gives up on its
+# request (Ctrl-C, timeout), writes the ID into the lane's cancel slot at the
+# end of the header. The watcher checks it before it starts the work and
+# between the steps of a transfer, drops the work and acknowledges the
+# request, so the lane is free for the next client right away.
+#
+# A request also carries its source (see admission.py), and the header
+# holds the limits, which the watcher announces: the largest payload in KiB,
+# so clients reject larger ones without sending them, and whether requests
+# may be rejected for a rate, so clients wait for the answer to their copies.
+
+MAGIC = b"CLPD"
+VERSION = 3
+
+_HEADER = Struct("<4sHH")
+_FIELDS = Struct("<BBHIQ")
+_PROGRESS = Struct("<I4xQQ")
+_BEAT = Struct("<I")
+_COUNTERS = Struct("<QQ")
+_LANE = Struct("<BBHIQIIQQQQ")
+_SEQ = Struct("<Q")
+_SOURCE = Struct("<I")
+_GENERATION = Struct("<Q")
+_VALUE = Struct("<QI")
+_LEASE = Struct("<d")
+_LIMITS = Struct("<II")
+
+HEADER_SIZE = 64
+LANE_SIZE = 4096
+LANES = (State.COPY, State.PASTE)
+RECORD_SIZE = HEADER_SIZE + LANE_SIZE * len(LANES)
+
+_PROGRESS_OFFSET = _FIELDS.size
+_SEQ_OFFSET = _PROGRESS_OFFSET + _PROGRESS.size
+_ACK_OFFSET = _SEQ_OFFSET + _SEQ.size
+_SOURCE_OFFSET = _PROGRESS_OFFSET + _BEAT.size
+_INLINE = _LANE.size
+INLINE_SIZE = LANE_SIZE - _INLINE
+
+_LIMITS_OFFSET = _HEADER.size
+_GENERATION_OFFSET = 16
+_VALUE_OFFSET = _GENERATION_OFFSET + _GENERATION.size
+_WATCH_BEAT_OFFSET = _VALUE_OFFSET + _VALUE.size
+_LEASE_OFFSET = _WATCH_BEAT_OFFSET + _BEAT.size
+_CANCEL_OFFSET = _LEASE_OFFSET + _LEASE.size
+
+FLAG_INLINE = 1
+FLAG_CHUNKED = 2
+FLAG_RING = 4
+# the first APPEND of a follow stream
+FLAG_START = 8
+CHUNK_SIZE = 1 << 20
+# requests may be rejected for a rate limit
+LIMIT_RATE = 1
+# the watcher records a trace, which the clip tool joins
+WATCHER_TRACE = 2
+# the watcher keeps the chunk store, the clip tool writes payloads into it
+WATCHER_CHUNKS = 4
+# the watcher reads and writes large payloads through the shared memory rings
+WATCHER_SHM = 8
+
+_STATES = list(State)
+
+
+class Cancelled(Exception):
+    """The client has cancelled the request, which the watcher handles"""
+
+
+class LaneFields(NamedTuple):
+    op: State
+    status: State
+    flags: int
+    crc: int
+    length: int
+    beat: int
+    source: int
+    total: int
+    progress: int
+    seq: int
+    ack: int
+
+
+class Lane:
+    __slots__ = ("record", "name", "offset", "slot", "ring", "serving",
+                 "__cancel", "__map")
+
+    def __init__(self, record: "StateRecord", index: int):
+        self.record = record
+        self.name = LANES[index].value
+        self.offset = HEADER_SIZE + index * LANE_SIZE
+        self.slot = record.path.parent / f"{DATAFILE}.{self.name}"
+        self.ring = None
+        # the request, which the watcher handles, 0 when idle
+        self.serving = 0
+        self.__cancel = _CANCEL_OFFSET + index * _SEQ.size
+        self.__map = record.map
+
+    @property
+    def seq(self) -> int:
+        return _SEQ.unpack_from(self.__map, self.offset + _SEQ_OFFSET)[0]
+
+    @property
+    def ack(self) -> int:
+        return _SEQ.unpack_from(self.__map, self.offset + _ACK_OFFSET)[0]
+
+    @property
+    def pending(self) -> bool:
+        return self.seq != self.ack
+
+    def liveness(self) -> tuple:
+        """Changes, while the watcher makes any progress on the request"""
+        return _PROGRESS.unpack_from(self.__map,
+                                     self.offset + _PROGRESS_OFFSET)
+
+    def read(self) -> LaneFields:
+        op, status, *fields = _LANE.unpack_from(self.__map, self.offset)
+        return LaneFields(_STATES[op], _STATES[status], *fields)
+
+    def request(self, op: State, flags: int = 0, crc: int = 0,
+                length: int = 0) -> int:
+        """Publishes a request, returns its sequence number"""
+        seq = self.seq + 1
+        self.__write(op, State.NONE, flags, crc, length)
+        _PROGRESS.pack_into(self.__map, self.offset + _PROGRESS_OFFSET,
+                            0, 0, 0)
+        _SOURCE.pack_into(self.__map, self.offset + _SOURCE_OFFSET,
+                          self.record.source)
+        _SEQ.pack_into(self.__map, self.offset + _SEQ_OFFSET, seq)
+        return seq
+
+    def cancel(self, seq: int) -> None:
+        """Client side: the request is abandoned"""
+        _SEQ.pack_into(self.__map, self.__cancel, seq)
+
+    @property
+    def cancelled(self) -> bool:
+        """The current request is abandoned by its client"""
+        seq = self.seq
+        return seq != 0 and \
+            _SEQ.unpack_from(self.__map, self.__cancel)[0] == seq
+
+    def check(self) -> None:
+        """
+        Watcher side: raises Cancelled, if the client gave up on the request
+        being handled, or a newer request replaced it
+        """
+        if self.serving and (self.cancelled or self.seq != self.serving):
+            raise Cancelled(f"Request {self.serving} is cancelled")
+
+    def heartbeat(self) -> None:
+        offset = self.offset + _PROGRESS_OFFSET
+        beat = _BEAT.unpack_from(self.__map, offset)[0]
+        _BEAT.pack_into(self.__map, offset, (beat + 1) & 0xffffffff)
+
+    def report(self, progress: int, total: int) -> None:
+        self.check()
+        _COUNTERS.pack_into(self.__map, self.offset + _PROGRESS_OFFSET + 8,
+                            total, progress)
+
+    def respond(self, status: State, flags: int = 0, crc: int = 0,
+                length: int = 0, seq: Optional[int] = None) -> None:
+        """
+        Publishes the response to the pending request. With seq, it is
+        dropped, unless seq is still the pending request.
+        """
+        self.check()
+        if seq is not None and seq != self.seq:
+            return
+        self.__write(self.read().op, status, flags, crc, length)
+        _SEQ.pack_into(self.__map, self.offset + _ACK_OFFSET, self.seq)
+
+    def __write(self, op: State, status: State, flags: int, crc: int,
+                length: int) -> None:
+        _FIELDS.pack_into(self.__map, self.offset, _STATES.index(op),
+                          _STATES.index(status), flags, crc, length)
+
+    def inline(self, length: int) -> bytes:
+        start = self.offset + _INLINE
+        return self.__map[start:start + length]
+
+    def write_inline(self, data: bytes) -> None:
+        start = self.offset + _INLINE
+        self.__map[start:start + len(data)] = data
+
+    # Clients of a lane are serialized with a POSIX lock on its byte range
+
+    def lock(self) -> None:
+        lockf(self.record.fd, LOCK_EX, LANE_SIZE, self.offset)
+
+    def unlock(self) -> None:
+        lockf(self.record.fd, LOCK_UN, LANE_SIZE, self.offset)
+
+
+class StateRecord:
+    __slots__ = ("path", "fd", "map", "lanes", "broadcast", "source")
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.fd = os_open(path, O_RDWR | O_CREAT, 0o644)
+        if fstat(self.fd).st_size < RECORD_SIZE:
+            ftruncate(self.fd, RECORD_SIZE)
+        self.map = mmap(self.fd, RECORD_SIZE)
+        if not self.__valid():
+            lockf(self.fd, LOCK_EX, HEADER_SIZE)
+            try:
+                # either new file or a state from the previous versions
+                if not self.__valid():
+                    self.map[:] = bytes(RECORD_SIZE)
+                    _HEADER.pack_into(self.map, 0, MAGIC, VERSION,
+                                      len(LANES))
+            finally:
+                lockf(self.fd, LOCK_UN, HEADER_SIZE)
+        self.lanes = tuple(Lane(self, i) for i in range(len(LANES)))
+        self.broadcast = Broadcast(self)
+        # client side: the source of requests, see admission.py
+        self.source = 0
+
+    def __valid(self) -> bool:
+        magic, version, _ = _HEADER.unpack_from(self.map, 0)
+        return magic == MAGIC and version == VERSION
+
+    @property
+    def max_payload(self) -> int:
+        """Largest payload, which the watcher accepts, 0 if unlimited"""
+        return _LIMITS.unpack_from(self.map, _LIMITS_OFFSET)[0] << 10
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.__announced(LIMIT_RATE)
+
+    @property
+    def tracing(self) -> bool:
+        return self.__announced(WATCHER_TRACE)
+
+    @property
+    def chunking(self) -> bool:
+        return self.__announced(WATCHER_CHUNKS)
+
+    @property
+    def sharing(self) -> bool:
+        return self.__announced(WATCHER_SHM)
+
+    def __announced(self, flag: int) -> bool:
+        return bool(_LIMITS.unpack_from(self.map, _LIMITS_OFFSET)[1] & flag)
+
+    def announce(self, max_payload: int = 0, flags: int = 0) -> None:
+        """
+        Watcher side: publishes the admission limits and the LIMIT_* and
+        WATCHER_* flags; the clip tool follows them, until they are changed
+        """
+        _LIMITS.pack_into(self.map, _LIMITS_OFFSET, max_payload >> 10, flags)
+
+    def lane(self, op: State) -> Lane:
+        """Lane of the operation; HALT and APPEND go with copies"""
+        return self.lanes[1 if op == State.PASTE else 0]
+
+    def close(self) -> None:
+        self.map.close()
+        close(self.fd)
+
+
+class Broadcast:
+    __slots__ = ("slot", "__map")
+
+    def __init__(self, record: StateRecord):
+        self.slot = record.path.parent / f"{DATAFILE}.watch"
+        self.__map = record.map
+
+    @property
+    def generation(self) -> int:
+        return _GENERATION.unpack_from(self.__map, _GENERATION_OFFSET)[0]
+
+    @property
+    def beat(self) -> int:
+        return _BEAT.unpack_from(self.__map, _WATCH_BEAT_OFFSET)[0]
+
+    @property
+    def lease(self) -> float:
+        return _LEASE.unpack_from(self.__map, _LEASE_OFFSET)[0]
+
+    # watcher side
+
+    def subscribed(self) -> bool:
+        return self.lease > time()
+
+    def heartbeat(self) -> None:
+        _BEAT.pack_into(self.__map, _WATCH_BEAT_OFFSET,
+                        (self.beat + 1) & 0xffffffff)
+
+    def publish(self, data: bytes) -> int:
+        """Publishes a new value, returns its generation"""
+        tmp = self.slot.with_name(f"{self.slot.name}.{getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        replace(tmp, self.slot)
+        _VALUE.pack_into(self.__map, _VALUE_OFFSET, len(data), crc32(data))
+        generation = self.generation + 1
+        _GENERATION.pack_into(self.__map, _GENERATION_OFFSET, generation)
+        return generation
+
+    # subscriber side
+
+    def subscribe(self, seconds: float) -> None:
+        """Renews the lease; the longest one of all subscribers holds"""
+        lease = time() + seconds
+        if lease > self.lease:
+            _LEASE.pack_into(self.__map, _LEASE_OFFSET, lease)
+
+    def read(self) -> Tuple[int, Optional[bytes]]:
+        """
+        Published value and its generation. The value is None, if the
+        watcher replaces it meanwhile; then the generation is already new.
+        """
+        generation = self.generation
+        length, crc = _VALUE.unpack_from(self.__map, _VALUE_OFFSET)
+        try:
+            with open(self.slot, "rb") as f:
+                data = f.read(length + 1)
+        except FileNotFoundError:
+            data = None
+        if generation != self.generation or data is None or \
+                len(data) != length or crc32(data) != crc:
+            return self.generation, None
+        return generation, data
+
+
+def write_payload(lane: Lane, data: bytes,
+                  store: Optional[ChunkStore] = None) -> tuple:
+    """
+    Stores payload inline, when it fits, or in the lane's data slot, or as a
+    manifest of chunks, when the chunk store is given. Returns (flags, crc,
+    length) to pass to `request` or `respond`.
+    """
+    if store is not None and len(data) > INLINE_SIZE:
+        manifest, written = store.put(data, lane.report)
+        emit(Event.CHUNKS_WRITTEN, state_code(lane.read().op), written)
+        flags, crc, length = _write_payload(lane, manifest)
+        return flags | FLAG_CHUNKED, crc, length
+    return _write_payload(lane, data)
+
+
+def send_payload(lane: Lane, data: bytes, publish: Callable[..., None],
+                 store: Optional[ChunkStore] = None) -> None:
+    """
+    Stores the payload and publishes it with `publish(flags, crc, length)`
+    (a partial of `request` or `respond`). A ring transfer is published
+    first, and then the payload is streamed, while the peer reads it.
+    """
+    if lane.ring is not None and len(data) > INLINE_SIZE:
+        lane.ring.reset()
+        publish(FLAG_RING, crc32(data), len(data))
+        lane.ring.write(data, lane.report, _watcher_alive(lane))
+    else:
+        publish(*write_payload(lane, data, store))
+
+
+def _watcher_alive(lane: Lane) -> Optional[Callable[[], tuple]]:
+    """
+    Client side: the watcher's liveness, as long as it may start reading a
+    ring transfer late; the watcher itself waits for the client's progress
+    only.
+    """
+    return None if lane.serving else lane.liveness
+
+
+def _write_payload(lane: Lane, data: bytes) -> tuple:
+    crc = crc32(data)
+    total = len(data)
+    if total <= INLINE_SIZE:
+        lane.write_inline(data)
+        lane.report(total, total)
+        return FLAG_INLINE, crc, total
+    tmp = lane.slot.with_name(f"{lane.slot.name}.{getpid()}.tmp")
+    view = memoryview(data)
+    with open(tmp, "wb") as f:
+        for start in range(0, total, CHUNK_SIZE):
+            f.write(view[start:start + CHUNK_SIZE])
+            lane.report(min(start + CHUNK_SIZE, total), total)
+    replace(tmp, lane.slot)
+    return 0, crc, total
+
+
+def read_payload(lane: Lane) -> bytes:
+    fields = lane.read()
+    data = _read_raw(lane, fields)
+    if fields.flags & FLAG_CHUNKED:
+        return _chunk_store(lane).get(data)
+    return data
+
+
+def defer_payload(lane: Lane, path: Path) -> Optional[Callable[[], bytes]]:
+    """
+    Takes the payload without reading it: the data slot is moved to path, a
+    manifest of chunks is kept. Returns a loader of the payload, or None, if
+    the payload must be read right away: it is inline or in the ring.
+    """
+    fields = lane.read()
+    if fields.flags & FLAG_CHUNKED:
+        store = _chunk_store(lane)
+        manifest = _read_raw(lane, fields)
+        # the chunks must outlive pruning, while the copy is offered
+        store.pin(manifest)
+        return partial(store.get, manifest)
+    if fields.flags & (FLAG_INLINE | FLAG_RING):
+        # a ring transfer must be read now, while the client streams it
+        return None
+    replace(lane.slot, path)
+    return partial(_read_file, path, fields)
+
+
+def payload_size(lane: Lane) -> int:
+    """
+    Size of the request's payload; a chunked one is summed up from its
+    manifest, which is never in the ring, so the payload is still unread
+    """
+    fields = lane.read()
+    if fields.flags & FLAG_CHUNKED:
+        return _manifest_size(_read_raw(lane, fields))
+    return fields.length
+
+
+def _read_raw(lane: Lane, fields: LaneFields) -> bytes:
+    """Payload as it is stored in the lane: a manifest, if it is chunked"""
+    if fields.flags & FLAG_INLINE:
+        data = lane.inline(fields.length)
+    elif fields.flags & FLAG_RING:
+        if lane.ring is None:
+            raise RuntimeError("Payload is in shared memory, which is absent")
+        data = lane.ring.read(fields.length, _watcher_alive(lane))
+    else:
+        return _read_file(lane.slot, fields)
+    _check(data, fields)
+    return data
+
+
+def _read_file(path: Path, fields: LaneFields) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read(fields.length)
+    _check(data, fields)
+    return data
+
+
+def _check(data: bytes, fields: LaneFields) -> None:
+    if len(data) != fields.length or crc32(data) != fields.crc:
+        raise RuntimeError(f"Corrupted payload: expected {fields.length} "
+                           f"bytes, got {len(data)}")
+
+
+def _chunk_store(lane: Lane) -> ChunkStore:
+    store = ChunkStore.open(lane.record.path.parent)
+    if store is None:
+        raise RuntimeError("Payload is chunked, but chunk store is absent")
+    return store
+
+
+class RecordWatcher:
+    refresh_in_seconds = poll_interval(0.01)
+    __slots__ = ("lane", "__callback", "__args", "__kwargs")
+
+    def __init__(self, lane: Lane,
+                 request_callback: Callable[..., None], *args, **kwargs):
+        self.lane = lane
+        self.__callback = request_callback
+        self.__args = args
+        self.__kwargs = kwargs
+
+    async def look(self) -> None:
+        if not self.lane.pending:
+            return
+        emit(Event.POLL_HIT, state_code(self.lane.read().op), self.lane.seq)
+        if iscoroutinefunction(self.__callback):
+            await self.__callback(*self.__args, **self.__kwargs)
+        else:
+            self.__callback(*self.__args, **self.__kwargs)
+
+    async def watch(self) -> None:
+        while True:
+            await self.look()
+            await sleep(self.refresh_in_seconds)
@@ -4,7 +4,11 @@ from sys import exit
 
 
 def run() -> int:
-    exit(_run(main(ClipdisType.CLIP)))
+    try:
+        exit(_run(main(ClipdisType.CLIP)))
+    except KeyboardInterrupt:
+        # the request is cancelled already
+        exit(130)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import logging
+
+from select import select
+from threading import Event, Lock, Thread
+from typing import Callable, Optional
+
+try:
+    from Xlib import X, Xatom
+    from Xlib.display import Display
+    from Xlib.protocol.event import SelectionNotify
+except ImportError:
+    Display = None
+
+# Lazy ("promise") copies. The watcher takes ownership of the host's
+# CLIPBOARD selection with only a loader of the copied payload, and the
+# payload is read, when a host application requests the selection. So a copy,
+# which is never pasted on the host, costs a rename of its data slot.
+#
+# X11 only, requires python-xlib. Payloads larger than _CHUNK are sent with
+# the INCR protocol: the requestor deletes the property after reading each
+# chunk, and the next one is written.
+
+_CHUNK = 64 << 10
+_TEXT_TARGETS = ("UTF8_STRING", "text/plain;charset=utf-8", "STRING", "TEXT")
+_poll_sec = 0.1
+
+
+class SelectionOwner:
+    def __init__(self, display):
+        self.display = display
+        self.window = display.screen().root.create_window(
+            0, 0, 1, 1, 0, X.CopyFromParent)
+        self.selection = display.intern_atom("CLIPBOARD")
+        self.targets = display.intern_atom("TARGETS")
+        self.incr = display.intern_atom("INCR")
+        self.text_targets = [display.intern_atom(t) for t in _TEXT_TARGETS]
+        self.__loader: Optional[Callable[[], bytes]] = None
+        # (requestor, property) -> [requestor, target, data, offset]
+        self.__transfers = {}
+        self.__lock = Lock()
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__serve, daemon=True)
+        self.__thread.start()
+
+    @classmethod
+    def open(cls) -> Optional["SelectionOwner"]:
+        """None, if python-xlib or the X display is not available"""
+        if Display is None:
+            logging.warning("Lazy copies require python-xlib, "
+                            "copying eagerly")
+            return None
+        try:
+            display = Display()
+        except Exception as err:
+            logging.warning(f"Lazy copies require X display ({err}), "
+                            "copying eagerly")
+            return None
+        return cls(display)
+
+    def offer(self, loader: Callable[[], bytes]) -> None:
+        """Takes the selection, loader is called on the first request"""
+        with self.__lock:
+            self.__loader = loader
+            self.window.set_selection_owner(self.selection, X.CurrentTime)
+            self.display.flush()
+
+    def claimed(self) -> Optional[bytes]:
+        """The offered payload, if the selection is still ours"""
+        with self.__lock:
+            return self.__load() if self.__owned() else None
+
+    def close(self, host_copy: Callable[[bytes], None]) -> None:
+        self.__stop.set()
+        self.__thread.join()
+        # do not lose the value, when the watcher exits
+        data = self.__load() if self.__owned() else None
+        self.display.close()
+        if data is not None:
+            host_copy(data)
+
+    def __owned(self) -> bool:
+        if self.__loader is None:
+            return False
+        owner = self.display.get_selection_owner(self.selection)
+        return getattr(owner, "id", owner) == self.window.id
+
+    def __load(self) -> Optional[bytes]:
+        """
+        Loads the payload for each request, it is not kept between them.
+        Requests are rare, and a large copy would stay in memory otherwise.
+        """
+        if self.__loader is None:
+            return None
+        try:
+            return self.__loader()
+        except (OSError, RuntimeError) as err:
+            logging.error(f"Lazy copy is lost: {err}")
+            self.__loader = None
+            return None
+
+    def __serve(self) -> None:
+        fd = self.display.fileno()
+        while not self.__stop.is_set():
+            select([fd], [], [], _poll_sec)
+            with self.__lock:
+                try:
+                    while self.display.pending_events():
+                        self.__handle(self.display.next_event())
+                    self.display.flush()
+                except Exception as err:
+                    logging.error(f"Selection request failed: {err}")
+
+    def __handle(self, e) -> None:
+        if e.type == X.SelectionRequest:
+            self.__request(e)
+        elif e.type == X.SelectionClear:
+            if not self.__owned():
+                logging.info("Lazy copy is replaced on the host")
+                self.__loader = None
+        elif e.type == X.PropertyNotify and e.state == X.PropertyDelete:
+            self.__send_next((e.window.id, e.atom))
+
+    def __request(self, e) -> None:
+        # obsolete clients do not set the property
+        prop = e.property or e.target
+        requestor = e.requestor
+        if self.__loader is None:
+            prop = X.NONE
+        elif e.target == self.targets:
+            requestor.change_property(prop, Xatom.ATOM, 32,
+                                      [self.targets, *self.text_targets])
+        elif e.target in self.text_targets:
+            data = self.__load()
+            if data is None:
+                prop = X.NONE
+            elif len(data) > _CHUNK:
+                requestor.change_attributes(event_mask=X.PropertyChangeMask)
+                requestor.change_property(prop, self.incr, 32, [len(data)])
+                self.__transfers[(requestor.id, prop)] = \
+                    [requestor, e.target, memoryview(data), 0]
+            else:
+                requestor.change_property(prop, e.target, 8, data)
+        else:
+            prop = X.NONE
+        requestor.send_event(SelectionNotify(
+            time=e.time, requestor=requestor, selection=e.selection,
+            target=e.target, property=prop))
+
+    def __send_next(self, key: tuple) -> None:
+        transfer = self.__transfers.get(key)
+        if transfer is None:
+            return
+        requestor, target, data, offset = transfer
+        chunk = bytes(data[offset:offset + _CHUNK])
+        # an empty chunk ends the transfer
+        requestor.change_property(key[1], target, 8, chunk)
+        if chunk:
+            transfer[3] = offset + len(chunk)
+        else:
+            del self.__transfers[key]
@@ -0,0 +1,215 @@
+from mmap import mmap
+from os import open as os_open, close, ftruncate, pread, unlink, urandom, \
+    O_RDWR, O_CREAT, O_EXCL
+from pathlib import Path
+from struct import Struct, error as struct_error
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+from .constants import SHMFILE
+
+# Shared memory transport. When a container shares /dev/shm with the host
+# (`docker run --ipc=host` or /dev/shm mounted into the container), large
+# payloads go through a ring buffer per lane in a shared memory file instead
+# of the data slots in the volume. The watcher creates the file and writes
+# its path and a random token into `.shm` in the clipboard directory, and
+# announces it in the state record. The clip tool uses the rings, while they
+# are announced, if it opens the file and finds the same token there, and
+# falls back to the data slots otherwise. A watcher, which was killed, leaves
+# `.shm` behind, so the next one removes it at start.
+#
+#     header | control of each lane | ring of each lane
+#
+# A ring has two counters: bytes written by the producer (head) and bytes
+# read by the consumer (tail), on separate cache lines. The producer writes
+# while the ring has room, the consumer reads while it has data, so a payload
+# of any size streams through a fixed buffer, both sides working at the same
+# time. Request and response still go through the lane: a ring transfer is
+# published before it starts, so the peer starts reading right away.
+#
+# Waits are adaptive: a short spin, then sleeps growing up to a millisecond.
+# A peer, which makes no progress for stall_timeout_sec, is considered dead,
+# unless it shows other signs of life: the watcher may publish a copy and
+# start reading it only after other work, while it beats the lane heartbeat.
+
+SHM_DIR = Path("/dev/shm")
+MAGIC = b"CLPS"
+VERSION = 1
+
+_HEADER = Struct("<4sHHQ16s")
+_COUNTER = Struct("<Q")
+HEADER_SIZE = 64
+CONTROL_SIZE = 128
+_HEAD = 0
+_TAIL = 64
+
+# bytes published at once, so the consumer may start early
+_STEP = 1 << 20
+_SPINS = 200
+_MIN_SLEEP_SEC = 50e-6
+_MAX_SLEEP_SEC = 1e-3
+
+stall_timeout_sec = 1
+
+
+class Ring:
+    __slots__ = ("map", "control", "data", "size")
+
+    def __init__(self, map: mmap, control: int, data: int, size: int):
+        self.map = map
+        self.control = control
+        self.data = data
+        self.size = size
+
+    @property
+    def head(self) -> int:
+        return _COUNTER.unpack_from(self.map, self.control + _HEAD)[0]
+
+    @property
+    def tail(self) -> int:
+        return _COUNTER.unpack_from(self.map, self.control + _TAIL)[0]
+
+    def reset(self) -> None:
+        """
+        Drops data of an abandoned transfer. Called by the producer before
+        it publishes a transfer, when no consumer reads the ring.
+        """
+        _COUNTER.pack_into(self.map, self.control + _TAIL, self.head)
+
+    def write(self, data: bytes,
+              report: Optional[Callable[[int, int], None]] = None,
+              alive: Optional[Callable[[], object]] = None) -> None:
+        """
+        Streams data into the ring. While the ring is full, the consumer is
+        waited for as long as alive() keeps changing.
+        """
+        view = memoryview(data)
+        total = len(data)
+        head = self.head
+        done = 0
+        while done < total:
+            free = self.size - (head - self.tail)
+            if not free:
+                _wait_change(lambda: self.tail, head - self.size, alive)
+                continue
+            pos = head % self.size
+            n = min(free, total - done, self.size - pos, _STEP)
+            start = self.data + pos
+            self.map[start:start + n] = view[done:done + n]
+            head += n
+            done += n
+            _COUNTER.pack_into(self.map, self.control + _HEAD, head)
+            if report:
+                report(done, total)
+
+    def read(self, length: int,
+             alive: Optional[Callable[[], object]] = None) -> bytearray:
+        out = bytearray(length)
+        tail = self.tail
+        done = 0
+        with memoryview(self.map) as view:
+            while done < length:
+                ready = self.head - tail
+                if not ready:
+                    _wait_change(lambda: self.head, tail, alive)
+                    continue
+                pos = tail % self.size
+                n = min(ready, length - done, self.size - pos, _STEP)
+                start = self.data + pos
+                out[done:done + n] = view[start:start + n]
+                tail += n
+                done += n
+                _COUNTER.pack_into(self.map, self.control + _TAIL, tail)
+        return out
+
+
+def _wait_change(counter: Callable[[], int], value: int,
+                 alive: Optional[Callable[[], object]] = None) -> None:
+    for _ in range(_SPINS):
+        if counter() != value:
+            return
+    delay = _MIN_SLEEP_SEC
+    sign = alive() if alive else None
+    deadline = monotonic() + stall_timeout_sec
+    while counter() == value:
+        if alive and alive() != sign:
+            sign = alive()
+            deadline = monotonic() + stall_timeout_sec
+        elif monotonic() > deadline:
+            raise RuntimeError("Shared memory peer stopped responding")
+        sleep(delay)
+        delay = min(delay * 2, _MAX_SLEEP_SEC)
+
+
+class SharedMemory:
+    __slots__ = ("path", "fd", "map")
+
+    def __init__(self, path: Path, fd: int, size: int):
+        self.path = path
+        self.fd = fd
+        self.map = mmap(fd, size)
+
+    def rings(self) -> tuple:
+        _, _, lanes, ring_size, _ = _HEADER.unpack_from(self.map, 0)
+        data = HEADER_SIZE + CONTROL_SIZE * lanes
+        return tuple(Ring(self.map, HEADER_SIZE + CONTROL_SIZE * i,
+                          data + ring_size * i, ring_size)
+                     for i in range(lanes))
+
+    def attach(self, record) -> None:
+        """Lanes of the record send large payloads through the rings"""
+        for lane, ring in zip(record.lanes, self.rings()):
+            lane.ring = ring
+
+    @classmethod
+    def create(cls, directory: Path, lanes: int,
+               ring_size: int) -> "SharedMemory":
+        """Watcher side: creates the file and announces it in `.shm`"""
+        remove(directory)
+        token = urandom(16)
+        path = SHM_DIR / f"clipdis-{token.hex()}"
+        size = HEADER_SIZE + (CONTROL_SIZE + ring_size) * lanes
+        fd = os_open(path, O_RDWR | O_CREAT | O_EXCL, 0o600)
+        ftruncate(fd, size)
+        shm = cls(path, fd, size)
+        _HEADER.pack_into(shm.map, 0, MAGIC, VERSION, lanes, ring_size, token)
+        (Path(directory) / SHMFILE).write_text(f"{path}\n{token.hex()}\n")
+        return shm
+
+    @classmethod
+    def open(cls, directory: Path) -> Optional["SharedMemory"]:
+        """Clip tool side: None, if the watcher's memory is not shared"""
+        try:
+            path, token = (Path(directory) / SHMFILE).read_text().split()
+            fd = os_open(path, O_RDWR)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, version, lanes, ring_size, own = \
+                _HEADER.unpack(pread(fd, _HEADER.size, 0))
+            if magic != MAGIC or version != VERSION or own.hex() != token:
+                raise ValueError("Foreign shared memory")
+            size = HEADER_SIZE + (CONTROL_SIZE + ring_size) * lanes
+            return cls(Path(path), fd, size)
+        except (OSError, ValueError, struct_error):
+            close(fd)
+            return None
+
+    def close(self) -> None:
+        self.map.close()
+        close(self.fd)
+
+
+def remove(directory: Path) -> None:
+    """Removes the shared memory file announced in the directory"""
+    file = Path(directory) / SHMFILE
+    try:
+        path = Path(file.read_text().split()[0])
+        if path.parent == SHM_DIR:
+            unlink(path)
+    except (OSError, IndexError):
+        pass
+    try:
+        unlink(file)
+    except FileNotFoundError:
+        pass
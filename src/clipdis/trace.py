@@ -0,0 +1,254 @@
+from enum import Enum
+from os import O_APPEND, O_CREAT, O_WRONLY, fstat, getpid, \
+    open as os_open, write
+from pathlib import Path
+from struct import Struct
+from sys import executable, exit
+from time import perf_counter, sleep, time_ns
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, \
+    Tuple
+
+from .constants import TRACEFILE
+
+# Trace file is a sequence of fixed-size little-endian records:
+# timestamp (ns), pid, side, event, arg (usually a state code), value (size or
+# duration). Records are appended with a single write() to an O_APPEND
+# descriptor, so the watcher and the clip tool can share one file. Records,
+# which would grow the file beyond _max_size, are dropped. Events of a request
+# carry the request's state code in arg, which tells its lane, and the lane's
+# sequence number: STATE_WRITE of both sides, POLL_HIT and CALLBACK_START of
+# the watcher in value, so both sides are matched.
+#
+# The watcher and the clip tool only emit events, so the analysis and replay
+# tools import their dependencies, when they run.
+_RECORD = Struct("<QIBBHQ")
+_max_size = 64 << 20
+
+
+class Side(Enum):
+    WATCHER = 0
+    CLIP = 1
+
+
+class Event(Enum):
+    STATE_READ = 0
+    STATE_WRITE = 1
+    POLL_HIT = 2
+    CALLBACK_START = 3
+    CALLBACK_END = 4
+    OP_START = 5
+    OP_END = 6
+    TIMEOUT = 7
+    CHUNKS_WRITTEN = 8
+    CANCEL = 9
+    REJECT = 10
+
+
+class Record(NamedTuple):
+    timestamp: int
+    pid: int
+    side: Side
+    event: Event
+    arg: int
+    value: int
+
+
+class Tracer:
+    def __init__(self, path: Path, side: Side):
+        self.path = path
+        self.side = side
+        self.pid = getpid()
+        self.__fd = os_open(path, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+
+    def emit(self, event: Event, arg: int = 0, value: int = 0) -> None:
+        if fstat(self.__fd).st_size >= _max_size:
+            return
+        write(self.__fd, _RECORD.pack(time_ns(), self.pid, self.side.value,
+                                      event.value, arg, value))
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable(directory: Path, side: Side) -> None:
+    """
+    Enables tracing into the trace file in the clipboard directory. The
+    watcher traces with its --trace option and announces it in the state
+    record, the clip tool traces only while it is announced.
+    """
+    global _tracer
+    _tracer = Tracer(Path(directory) / TRACEFILE, side)
+
+
+def emit(event: Event, arg: int = 0, value: int = 0) -> None:
+    if _tracer is not None:
+        _tracer.emit(event, arg, value)
+
+
+def state_code(state: Enum) -> int:
+    return list(type(state)).index(state)
+
+
+def state_name(code: int) -> str:
+    from .common import State
+    return list(State)[code].value
+
+
+def _lane(code: int) -> int:
+    """Lane of the state code: pastes have their own, see record.LANES"""
+    return 1 if state_name(code) == "paste" else 0
+
+
+def read(path: Path) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        data = f.read()
+    end = len(data) - len(data) % _RECORD.size
+    for fields in _RECORD.iter_unpack(data[:end]):
+        ts, pid, side, event, arg, value = fields
+        yield Record(ts, pid, Side(side), Event(event), arg, value)
+
+
+class Operation(NamedTuple):
+    pid: int
+    op: str
+    size: int
+    start: int
+    end: int
+    events: List[Record]
+
+    @property
+    def latency(self) -> int:
+        return self.end - self.start
+
+
+def operations(records: Sequence[Record]) -> List[Operation]:
+    """
+    Reconstructs clip tool operations in one pass. Each operation spans from
+    OP_START to OP_END of one clip process. Watcher events are attributed to
+    the request, which their lane serves, also after OP_END, since a copy
+    returns before the watcher has handled it.
+    """
+    # pid -> [OP_START, events, (lane, seq)] of operations in progress
+    opened: Dict[int, list] = {}
+    ended = []
+    # watcher events by (lane, seq), and the sequence number each lane serves
+    requests: Dict[Tuple[int, int], List[Record]] = {}
+    serving: Dict[int, int] = {}
+    for r in sorted(records, key=lambda r: r.timestamp):
+        if r.side is Side.WATCHER:
+            lane = _lane(r.arg)
+            if r.event in (Event.POLL_HIT, Event.CALLBACK_START):
+                serving[lane] = r.value
+            if lane in serving:
+                requests.setdefault((lane, serving[lane]), []).append(r)
+            if r.event is Event.CALLBACK_END:
+                serving.pop(lane, None)
+        elif r.event is Event.OP_START:
+            opened[r.pid] = [r, [r], None]
+        elif r.pid in opened:
+            op = opened[r.pid]
+            op[1].append(r)
+            if r.event is Event.STATE_WRITE:
+                op[2] = (_lane(r.arg), r.value)
+            elif r.event is Event.OP_END:
+                del opened[r.pid]
+                ended.append((op, r))
+    ops = []
+    for (start, events, key), end in ended:
+        events = sorted(events + requests.get(key, []),
+                        key=lambda r: r.timestamp)
+        ops.append(Operation(end.pid, state_name(start.arg), end.value,
+                             start.timestamp, end.timestamp, events))
+    return ops
+
+
+def _percentile(values: List[int], p: float) -> int:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summary(ops: Sequence[Operation]) -> dict:
+    from statistics import median
+    result = {}
+    for name in {op.op for op in ops}:
+        lat = [op.latency for op in ops if op.op == name]
+        result[name] = {"count": len(lat),
+                        "p50_ms": median(lat) / 1e6,
+                        "p95_ms": _percentile(lat, 0.95) / 1e6,
+                        "max_ms": max(lat) / 1e6}
+    return result
+
+
+def _print_timeline(op: Operation) -> None:
+    print(f"{op.op} pid={op.pid} size={op.size} "
+          f"latency={op.latency / 1e6:.3f}ms")
+    for e in op.events:
+        offset = (e.timestamp - op.start) / 1e6
+        print(f"    +{offset:9.3f}ms {e.side.name.lower():7} "
+              f"{e.event.name.lower():14} arg={e.arg} value={e.value}")
+
+
+def _analyze(ns) -> int:
+    import json
+    ops = operations(list(read(ns.tracefile)))
+    if not ns.json:
+        for op in ops:
+            _print_timeline(op)
+    print(json.dumps(summary(ops), indent=2))
+    return 0
+
+
+def _replay(ns) -> int:
+    """
+    Replays recorded operations against a running watcher, preserving payload
+    sizes and the gaps between operations, and reports both latencies.
+    """
+    import json
+    import subprocess as sub
+    ops = operations(list(read(ns.tracefile)))
+    clip_cmd = [executable, "-m", "clipdis.run_clip",
+                "--directory", ns.directory]
+    replayed = []
+    prev_start = ops[0].start if ops else 0
+    for op in ops:
+        if not ns.no_gaps:
+            sleep(max(0, op.start - prev_start) / 1e9)
+        prev_start = op.start
+        begin = perf_counter()
+        if op.op == "copy":
+            sub.run(clip_cmd + ["--copy"], input=b'x' * op.size)
+        else:
+            sub.run(clip_cmd + ["--paste"], stdout=sub.DEVNULL)
+        elapsed = int((perf_counter() - begin) * 1e9)
+        replayed.append(op._replace(start=0, end=elapsed, events=[]))
+    print(json.dumps({"recorded": summary(ops),
+                      "replayed": summary(replayed)}, indent=2))
+    return 0
+
+
+def run() -> int:
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Analyze or replay clipdis traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze = subparsers.add_parser("analyze", help="Print operation "
+                                    "timelines and latency summary")
+    analyze.add_argument("tracefile", type=Path)
+    analyze.add_argument("--json", action="store_true",
+                         help="Print only the JSON summary")
+
+    replay = subparsers.add_parser("replay", help="Replay recorded workload "
+                                   "against a running watcher")
+    replay.add_argument("tracefile", type=Path)
+    replay.add_argument("--directory", type=str, required=True)
+    replay.add_argument("--no-gaps", action="store_true",
+                        help="Issue operations back to back")
+
+    ns = parser.parse_args()
+    if ns.command == "analyze":
+        return _analyze(ns)
+    return _replay(ns)
+
+
+if __name__ == "__main__":
+    exit(run())
@@ -1,46 +1,206 @@
 import logging
-import pyperclip as pyc
 import subprocess as sub
 
-from asyncio import CancelledError, sleep, create_task, gather
+from asyncio import CancelledError, sleep, create_task, ensure_future, \
+    gather, wait
 from pathlib import Path
-from typing import Sequence, Awaitable, Callable, TypeVar
+from typing import Callable, Optional, Tuple, TypeVar, TYPE_CHECKING
 from argparse import ArgumentParser
-from multiprocessing import Process, current_process
-from os import execvp
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from os import execvp, fork, setsid, pipe, read, write, close, waitpid, \
+    getpid, kill, ftruncate, open as os_open, _exit, O_RDWR, O_CREAT, dup2, \
+    devnull
+from select import select
 from functools import partial
 from shutil import which
-
-from .common import FileWatcher, ProcessWatcher, State, eopen, check_state, run
-from .constants import STATEFILE, DATAFILE
+from sys import modules
+from time import monotonic
+from zlib import crc32
+
+from .common import ProcessWatcher, State, run, run_in_executor
+from .constants import STATEFILE, PROMISEFILE, PROFILEFILE, ENCODING
+from .record import StateRecord, Lane, Broadcast, RecordWatcher, \
+    Cancelled, read_payload, send_payload, defer_payload, payload_size, \
+    FLAG_START, LIMIT_RATE, WATCHER_TRACE, WATCHER_CHUNKS, WATCHER_SHM
+from .chunks import ChunkStore
+from .group import ClipboardGroup, HostSync
+from .follow import Follow, APPEND_HEADER
+from .profiler import Profiler
+from .admission import Admission, Rejected
+from . import shm
+from .shm import SharedMemory
+from . import trace
+from .trace import Event, emit, state_code
+
+if TYPE_CHECKING:
+    from .selection import SelectionOwner
 
 LOCKFILE = ".lock"
-DETACHED_PROCESS_NAME = "clipdis-watcher"
-
 
-def _copy(filename: Path) -> None:
+T = TypeVar("T")
+
+# readiness handshake: the detached watcher writes one of these into the pipe
+_READY = b'r'
+_ALREADY_RUNNING = b'a'
+_ready_timeout_sec = 10
+
+# must be well below the clip tool's _wait_max_time_sec
+_heartbeat_sec = 0.1
+# a request, which makes no progress this long, fails (--stall-timeout)
+_stall_sec = 10.0
+# how often the host clipboard is read, while there are subscribers
+_watch_interval_sec = 0.2
+
+# mallopt parameter and its value, glibc's default
+_M_MMAP_THRESHOLD = -3
+_MMAP_THRESHOLD = 128 << 10
+# the heap is trimmed after operations with payloads of this size
+_trim_min_size = 1 << 20
+_libc = None
+
+
+def _pyperclip():
+    """
+    The host clipboard backend. The launcher forks the watcher, so the
+    watcher imports it on the first use instead of the launcher.
+    """
+    import pyperclip
+    return pyperclip
+
+
+def _pyperclip_error(err: Exception) -> bool:
+    """
+    Whether err comes from the backend; it is not imported here, since the
+    error may be its failed import
+    """
+    pyperclip = modules.get("pyperclip")
+    return pyperclip is not None and \
+        isinstance(err, pyperclip.PyperclipException)
+
+
+def _tune_allocator() -> None:
+    """
+    glibc allocates blocks above the mmap threshold in their own mappings,
+    which are returned to the system, when freed. But it raises the
+    threshold to the size of each freed block, so after one large payload
+    the next ones are allocated in the heap, which keeps its pages. A fixed
+    threshold gives every payload buffer back after the operation.
+    """
+    global _libc
+    from ctypes import CDLL
     try:
-        f = eopen(filename, "rt")
-        data = str(f.read())
-        pyc.copy(data)
-    except pyc.PyperclipException as err:
-        logging.error(f"Pyperclip error: {err}")
-    except Exception as err:
-        logging.error(f"File error: {err}")
-        raise
+        libc = CDLL(None)
+        libc.mallopt(_M_MMAP_THRESHOLD, _MMAP_THRESHOLD)
+        _libc = libc
+    except (OSError, AttributeError):
+        # not glibc
+        pass
+
+
+def _trim_heap(size: int) -> None:
+    """
+    Returns free heap pages after a large operation: the pieces a payload
+    is read or written in are freed in the middle of the heap, which glibc
+    does not shrink on its own.
+    """
+    if _libc is not None and size >= _trim_min_size:
+        _libc.malloc_trim(0)
+
+
+def _host_copy(data: bytes) -> None:
+    _pyperclip().copy(data.decode(ENCODING, errors="strict"))
+
+
+def _host_paste() -> bytes:
+    return _pyperclip().paste().encode(ENCODING, errors="strict")
+
+
+def _copy(lane: Lane, store: Optional[ChunkStore],
+          group: Optional[ClipboardGroup],
+          owner: Optional["SelectionOwner"]) -> int:
+    size = payload_size(lane)
+    loader = None
+    if group is None and owner is not None:
+        loader = defer_payload(lane, lane.record.path.parent / PROMISEFILE)
+    if loader is not None:
+        owner.offer(loader)
+        logging.info("Copied lazily")
     else:
+        data = read_payload(lane)
+        size = len(data)
+        lane.check()
+        if group is not None:
+            group.publish(data)
+        else:
+            _host_copy(data)
         logging.info("Copied")
-    finally:
-        f.close()
+    lane.respond(State.DONE)
+    if store is not None:
+        store.prune()
+    return size
+
+
+def _append(lane: Lane, follow: Follow, admission: Admission) -> int:
+    flags = lane.read().flags
+    data = memoryview(read_payload(lane))
+    window, = APPEND_HEADER.unpack_from(data)
+    if admission.max_payload:
+        # the window is the payload, which the watcher keeps
+        window = min(window, admission.max_payload)
+    follow.append(data[APPEND_HEADER.size:], window, flags & FLAG_START)
+    lane.respond(State.DONE)
+    return len(data) - APPEND_HEADER.size
+
+
+async def _sync_follow(data: bytes, group: Optional[ClipboardGroup],
+                       owner: Optional["SelectionOwner"],
+                       follow: Follow) -> None:
+    try:
+        if group is not None:
+            await run_in_executor(group.publish, data)
+            group.schedule_sync(_host_copy, _host_paste)
+        elif owner is not None:
+            # the selection is read on demand, so appends cost nothing
+            owner.offer(partial(bytes, follow.value))
+        else:
+            await run_in_executor(_host_copy, data)
+        logging.info(f"Followed stream synced, {len(data)} bytes")
+    except Exception as err:
+        logging.error(f"Followed stream sync failed: {err}")
+
+
+def _current_value(group: Optional[ClipboardGroup],
+                   owner: Optional["SelectionOwner"]) -> bytes:
+    data = group.latest() if group is not None else None
+    if data is None and owner is not None:
+        # the lazy copy, which is still the host's selection
+        data = owner.claimed()
+    if data is None:
+        data = _host_paste()
+    return data
+
+
+def _paste_value(lane: Lane, group: Optional[ClipboardGroup],
+                 owner: Optional["SelectionOwner"],
+                 admission: Admission) -> bytes:
+    data = _current_value(group, owner)
+    admission.check_size(len(data))
+    return data
+
+
+def _paste(lane: Lane, data: bytes, store: Optional[ChunkStore]) -> int:
+    seq = lane.seq
 
+    def respond(*fields) -> None:
+        lane.respond(State.DONE, *fields)
+        # a ring transfer is answered before it is streamed
+        emit(Event.STATE_WRITE, state_code(State.PASTE), seq)
 
-def _paste(datafile: Path, statefile: Path) -> None:
-    with eopen(datafile, "wt") as f:
-        data = pyc.paste()
-        f.write(data)
-    with eopen(statefile, "wt") as f:
-        f.write(State.DONE.value)
+    send_payload(lane, data, respond, store)
     logging.info("Pasted")
+    if store is not None:
+        store.prune()
+    return len(data)
 
 
 async def watcher() -> None:
@@ -63,16 +223,74 @@ async def watcher() -> None:
                         "when not specified")
     parser.add_argument("--dry-run", action='store_true',
                         help="Do not start docker container")
+    parser.add_argument("--trace", action='store_true',
+                        help="Record protocol events into the .trace file "
+                        "in the clipboard directory")
+    parser.add_argument("--chunks", action='store_true',
+                        help="Send large payloads through the chunk store, "
+                        "writing only chunks, which are not stored yet")
+    parser.add_argument("--chunks-max-size", type=int, default=512,
+                        help="Chunk store size limit in megabytes; "
+                        "by default: 512")
+    parser.add_argument("--shm", action='store_true',
+                        help="Stream large payloads through shared memory "
+                        "in /dev/shm, when the container shares it "
+                        "(--ipc=host); the volume is used otherwise")
+    parser.add_argument("--shm-size", type=int, default=8,
+                        help="Shared memory ring size of each direction in "
+                        "megabytes; by default: 8")
+    parser.add_argument("--lazy-copy", action='store_true',
+                        help="Take the host's selection without reading the "
+                        "copied data; it is read, when a host application "
+                        "pastes. X11 only, requires python-xlib")
+    parser.add_argument("-g", "--group", type=str,
+                        help="Directory of a clipboard group; containers of "
+                        "a group paste each other's copies directly")
+    parser.add_argument("--group-sync", type=str, default="lazy",
+                        choices=[s.value for s in HostSync],
+                        help="When group's copies reach the host clipboard: "
+                        "lazy - after --group-sync-delay seconds without "
+                        "copies, none - never; by default: lazy")
+    parser.add_argument("--group-sync-delay", type=float,
+                        default=ClipboardGroup.sync_delay_in_seconds)
+    parser.add_argument("--stall-timeout", type=float, default=_stall_sec,
+                        help="Fail a request, which makes no progress for "
+                        "this many seconds, e.g. a hung host clipboard call; "
+                        f"by default: {_stall_sec:g}")
+    parser.add_argument("--max-payload", type=int, default=0,
+                        help="Reject copies and pastes larger than this many "
+                        "megabytes; by default: unlimited")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Requests per second of each source, others "
+                        "are rejected; by default: unlimited")
+    parser.add_argument("--rate-burst", type=int, default=10,
+                        help="Requests a source may send at once within "
+                        "--rate-limit; by default: 10")
+    parser.add_argument("--bandwidth-limit", type=float, default=0,
+                        help="Megabytes per second of each source, requests "
+                        "above it are rejected; by default: unlimited")
     ns, args = parser.parse_known_args()
 
     if not (ns.dry_run or ns.cvolume and ns.hvolume):
         parser.print_usage()
         raise RuntimeWarning("Specify volume directories or run with --dry-run")
 
-    # spawn detached watcher
-    co_runner = partial(_run_co, _main,
-                        (ns.hvolume, ns.containername, ns.logfile, ns.dry_run))
-    await _spawn_detached(co_runner)
+    # spawn detached watcher and wait until it listens
+    group = None
+    if ns.group:
+        group = (ns.group, HostSync(ns.group_sync), ns.group_sync_delay)
+    target = partial(_detached_main, ns.hvolume, ns.containername,
+                     ns.logfile, ns.dry_run, ns.trace, ns.chunks,
+                     ns.chunks_max_size << 20, group, ns.lazy_copy,
+                     ns.shm_size << 20 if ns.shm else 0, ns.stall_timeout,
+                     Admission(ns.max_payload << 20, ns.rate_limit,
+                               ns.rate_burst,
+                               int(ns.bandwidth_limit * (1 << 20))))
+    status = _spawn_detached(target)
+    if status == _ALREADY_RUNNING:
+        print("Watcher is already running")
+    elif status != _READY:
+        raise RuntimeWarning("Watcher failed to start")
 
     if ns.dry_run:
         return
@@ -89,17 +307,166 @@ async def watcher() -> None:
     execvp("docker", docker_cmd)
 
 
-async def _callback(statefile: Path, datafile: Path,
-                    process_watcher: ProcessWatcher) -> None:
-    state = check_state(statefile)
-    if state != State.NONE:
-        logging.info(f"State changed: {state.value}")
+async def _callback(lane: Lane, process_watcher: ProcessWatcher,
+                    store: Optional[ChunkStore],
+                    group: Optional[ClipboardGroup],
+                    owner: Optional["SelectionOwner"], follow: Follow,
+                    admission: Admission) -> None:
+    fields = lane.read()
+    state = fields.op
+    seq = lane.seq
+    emit(Event.STATE_READ, state_code(state))
+    logging.info(f"State changed: {state.value}, request {seq}")
+    emit(Event.CALLBACK_START, state_code(state), seq)
+    size = 0
+    try:
+        if lane.cancelled:
+            # a request, which the client gave up on, takes no quota
+            raise Cancelled(f"Request {seq} is cancelled")
+        if state != State.HALT:
+            # the size of a paste is checked, when the value is read
+            admission.admit(fields.source,
+                            0 if state == State.PASTE else payload_size(lane))
+        # lanes are handled concurrently, clipboard calls block
         if state == State.COPY:
-            _copy(datafile)
+            # the followed stream must not overwrite the copy later
+            await follow.cancel_sync()
+            size = await _with_heartbeat(lane, _copy, store, group, owner)
+            if group is not None:
+                group.schedule_sync(_host_copy, _host_paste)
+        elif state == State.APPEND:
+            size = await _with_heartbeat(lane, _append, follow, admission)
+            follow.schedule_sync(partial(_sync_follow, group=group,
+                                         owner=owner, follow=follow))
         elif state == State.PASTE:
-            _paste(datafile, statefile)
-        elif state == State.HALT:
-            await process_watcher.cancel_tasks()
+            # the value does not touch the lane, so a hung host clipboard
+            # is left behind, as soon as the client cancels the paste
+            data = await _with_heartbeat(lane, _paste_value, group, owner,
+                                         admission, abandon=True)
+            size = await _with_heartbeat(lane, _paste, data, store)
+        else:
+            lane.respond(State.DONE)
+        admission.charge(fields.source, size)
+    except Rejected as err:
+        logging.warning(f"Request {seq} of source {fields.source} "
+                        f"rejected: {err}")
+        emit(Event.REJECT, state_code(state), err.reason.value)
+        lane.respond(State.REJECTED, err.reason.value, 0, err.value)
+    except Cancelled:
+        logging.info(f"Request {seq} cancelled by the client")
+        emit(Event.CANCEL, state_code(state), seq)
+        lane.respond(State.NONE, seq=seq)
+    except Exception as err:
+        if _pyperclip_error(err):
+            logging.error(f"Pyperclip error: {err}")
+        else:
+            logging.error(f"{state.value} failed: {err}")
+        lane.respond(State.NONE, seq=seq)
+    emit(Event.CALLBACK_END, state_code(state), size)
+    _trim_heap(size)
+    if state == State.HALT:
+        await process_watcher.cancel_tasks()
+
+
+def _publish_changed(broadcast: Broadcast, group: Optional[ClipboardGroup],
+                     owner: Optional["SelectionOwner"],
+                     last: Optional[tuple]) -> Tuple[tuple, Optional[int]]:
+    """
+    Publishes the current value, unless its (length, checksum) is last.
+    Returns them and the new generation, the value itself is not kept.
+    """
+    data = _current_value(group, owner)
+    current = (len(data), crc32(data))
+    return current, broadcast.publish(data) if current != last else None
+
+
+async def _serve_subscribers(broadcast: Broadcast,
+                             group: Optional[ClipboardGroup],
+                             owner: Optional["SelectionOwner"]) -> None:
+    """
+    While subscribers hold the lease, polls the host clipboard and publishes
+    every new value. Values are compared by checksum, not kept.
+    """
+    last = None
+    polled = 0
+    while True:
+        await sleep(_heartbeat_sec)
+        if not broadcast.subscribed():
+            # the value may change unnoticed, publish it anew
+            last = None
+            continue
+        broadcast.heartbeat()
+        if monotonic() - polled < _watch_interval_sec:
+            continue
+        polled = monotonic()
+        try:
+            last, generation = await run_in_executor(
+                _publish_changed, broadcast, group, owner, last)
+        except Exception as err:
+            logging.error(f"Watching the clipboard failed: {err}")
+            continue
+        if generation is not None:
+            logging.info(f"Clipboard value {generation} published")
+        _trim_heap(last[0])
+
+
+async def _with_heartbeat(lane: Lane, handler: Callable[..., T], *args,
+                          abandon: bool = False) -> T:
+    lane.serving = lane.seq
+    try:
+        return await _until_stalled(
+            lane, run_in_executor(handler, lane, *args), abandon)
+    finally:
+        lane.serving = 0
+
+
+async def _until_stalled(lane: Lane, work, abandon: bool = False):
+    """
+    Beats the heartbeat, while the handler makes progress. A handler, which
+    reports none for _stall_sec (e.g. a host clipboard call, which hangs),
+    fails the request, so the client does not wait for it forever. The
+    handler is cancelled then, so its late response is dropped. A handler,
+    which does not write to the lane, is abandoned instead, also as soon as
+    the client cancels the request, so the lane serves the next one.
+    """
+    work = ensure_future(work)
+    progress = lane.liveness()[1:]
+    deadline = monotonic() + _stall_sec
+    while True:
+        lane.heartbeat()
+        done, _ = await wait({work}, timeout=_heartbeat_sec)
+        if done:
+            return work.result()
+        if abandon and lane.cancelled:
+            _leave(work)
+            lane.check()
+        current = lane.liveness()[1:]
+        if current != progress:
+            progress = current
+            deadline = monotonic() + _stall_sec
+        elif monotonic() > deadline:
+            break
+    seq = lane.serving
+    try:
+        lane.respond(State.NONE, seq=seq)
+    except Cancelled:
+        # the client gave up already
+        pass
+    lane.cancel(seq)
+    if abandon:
+        _leave(work)
+    else:
+        # the lane is not served, until the handler returns
+        try:
+            await work
+        except Exception:
+            pass
+    raise TimeoutError(f"No progress for {_stall_sec:g} s")
+
+
+def _leave(work) -> None:
+    """Lets the work finish in the background, its result is dropped"""
+    work.add_done_callback(lambda f: f.cancelled() or f.exception())
 
 
 def _check_container(name: str, statefile: Path = "",
@@ -115,39 +482,167 @@ def _check_container(name: str, statefile: Path = "",
     return True
 
 
+class _WatcherLock:
+    """
+    Singleton lock of the clipboard directory: flock on the lock file, which
+    holds the owner's PID. The kernel releases it, when the owner dies, so a
+    crashed watcher never blocks a new one. On file systems without flock
+    the recorded PID is checked instead.
+    """
+
+    __slots__ = ("path", "fd")
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self) -> bool:
+        fd = os_open(self.path, O_RDWR | O_CREAT, 0o644)
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            close(fd)
+            return False
+        except OSError:
+            pid = _read_pid(fd)
+            if pid and pid != getpid() and _alive(pid):
+                close(fd)
+                return False
+        ftruncate(fd, 0)
+        write(fd, f"{getpid()}\n".encode())
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        if self.fd is None:
+            return
+        ftruncate(self.fd, 0)
+        flock(self.fd, LOCK_UN)
+        close(self.fd)
+        self.fd = None
+
+
+def _read_pid(fd: int) -> int:
+    try:
+        return int(read(fd, 32).decode() or 0)
+    except ValueError:
+        return 0
+
+
+def _alive(pid: int) -> bool:
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def running_pid(directory: Path) -> Optional[int]:
+    """PID of the watcher, which serves the directory, if there is one"""
+    try:
+        pid = int((Path(directory) / LOCKFILE).read_text() or 0)
+    except (FileNotFoundError, ValueError):
+        return None
+    return pid if pid and _alive(pid) else None
+
+
 async def _main(dir: str, containername: str, logfile: str,
-                dry_run: bool) -> None:
+                dry_run: bool, trace_on: bool, chunks_on: bool,
+                chunks_max_size: int, group_args: Optional[tuple],
+                lazy_copy: bool, shm_size: int, stall_timeout: float,
+                admission: Admission, ready_fd: int) -> None:
+    global _stall_sec
     dir = Path(dir)
-    lockfile = dir / LOCKFILE
+    lock = _WatcherLock(dir / LOCKFILE)
+    group = None
+    owner = None
+    memory = None
+    profiler = None
+    record = None
 
     try:
-        if lockfile.exists() or current_process().name != DETACHED_PROCESS_NAME:
+        if not lock.acquire():
+            write(ready_fd, _ALREADY_RUNNING)
             return
-        lockfile.touch()
 
         _configure_logger(logfile)
+        _tune_allocator()
+        _stall_sec = stall_timeout
+        if trace_on:
+            trace.enable(dir, trace.Side.WATCHER)
 
         tasks = set()
 
+        # reports go next to the log file
+        profiler = Profiler(dir if logfile == '_' else
+                            Path(logfile).resolve().parent)
+        profiler.install()
+        tasks.add(create_task(profiler.watch_control(dir / PROFILEFILE)))
+
         statefile = dir / STATEFILE
-        datafile = dir / DATAFILE
+        record = StateRecord(statefile)
+        flags = LIMIT_RATE if admission.rate_limited else 0
+        if trace_on:
+            flags |= WATCHER_TRACE
+        if chunks_on:
+            flags |= WATCHER_CHUNKS
+        store = ChunkStore.open(dir, create=True) if chunks_on else None
+        if store is not None:
+            store.max_size = chunks_max_size
+        if group_args is not None:
+            group_dir, sync, delay = group_args
+            group = ClipboardGroup(group_dir, containername, sync)
+            group.sync_delay_in_seconds = delay
+        if lazy_copy:
+            from .selection import SelectionOwner
+            owner = SelectionOwner.open()
+        # left behind by a watcher, which was killed
+        shm.remove(dir)
+        if shm_size:
+            try:
+                memory = SharedMemory.create(dir, len(record.lanes), shm_size)
+                memory.attach(record)
+                flags |= WATCHER_SHM
+            except OSError as err:
+                logging.warning(f"Shared memory is not available: {err}")
+        record.announce(admission.max_payload, flags)
 
         container_watcher = \
             ProcessWatcher(_check_container,
                            (containername, statefile, dry_run), tasks)
 
-        watcher = FileWatcher(statefile, _callback, statefile, datafile,
-                              container_watcher)
-        tasks.add(create_task(watcher.watch()))
+        follow = Follow()
+        for lane in record.lanes:
+            watcher = RecordWatcher(lane, _callback, lane, container_watcher,
+                                    store, group, owner, follow, admission)
+            tasks.add(create_task(watcher.watch()))
 
+        tasks.add(create_task(
+            _serve_subscribers(record.broadcast, group, owner)))
         if not dry_run:
             tasks.add(create_task(container_watcher.watch()))
 
+        write(ready_fd, _READY)
+        close(ready_fd)
         await gather(*tasks)
     except CancelledError:
         pass
     finally:
-        lockfile.unlink(missing_ok=True)
+        if profiler is not None:
+            profiler.stop()
+        if group is not None:
+            group.close(_host_copy, _host_paste)
+        if owner is not None:
+            owner.close(_host_copy)
+        if memory is not None:
+            memory.close()
+            shm.remove(dir)
+        if record is not None:
+            # clip tools stop tracing
+            record.announce()
+        lock.release()
 
 
 # utilities
@@ -160,6 +655,8 @@ def exec_start_attach_container(name: str) -> None:
 
 def _configure_logger(logfile: str):
     if logfile == '_':
+        # otherwise warnings fall back to stderr of the detached watcher
+        logging.getLogger().addHandler(logging.NullHandler())
         return
     name = "clipboard-watcher"
     logging.basicConfig(filename=logfile,
@@ -169,31 +666,40 @@ def _configure_logger(logfile: str):
     logging.info("Logging initialized")
 
 
-async def _spawn_detached(co: Awaitable):
-    # creates detached (orphaned) process by double forking it
-    p = _spawn_detached_impl(0, co)
-    await sleep(0.1)
-    if isinstance(p, Process):
-        p.terminate()
-
-
-def _spawn_detached_impl(count: int, co: Awaitable):
-    count += 1
-    if count < 2:
-        name = DETACHED_PROCESS_NAME + ".fork"
-    elif count == 2:
-        name = DETACHED_PROCESS_NAME
-    else:
-        return co()
-
-    p = Process(name=name, target=_spawn_detached_impl, args=(count, co),
-                daemon=False)
-    p.start()
-    return p
-
-
-_T = TypeVar("_T")
-
-
-def _run_co(co_func: Callable[..., Awaitable[_T]], args: Sequence) -> _T:
-    return run(co_func(*args))
+def _detached_main(*args, ready_fd: int) -> None:
+    run(_main(*args, ready_fd))
+
+
+def _spawn_detached(target: Callable[..., None]) -> bytes:
+    """
+    Creates detached (orphaned) process by double forking it. Its standard
+    streams are redirected to /dev/null, so it does not write to the
+    terminal, which it outlives. The target gets the write end of a pipe as
+    `ready_fd` and reports its readiness through it. Returns the reported
+    status, empty if the target died or did not answer in time.
+    """
+    rfd, wfd = pipe()
+    pid = fork()
+    if pid == 0:
+        close(rfd)
+        setsid()
+        if fork() == 0:
+            null = os_open(devnull, O_RDWR)
+            for fd in range(3):
+                dup2(null, fd)
+            close(null)
+            try:
+                target(ready_fd=wfd)
+            except BaseException as err:
+                logging.error(f"Watcher failed: {err}")
+            finally:
+                _exit(0)
+        _exit(0)
+
+    close(wfd)
+    waitpid(pid, 0)
+    try:
+        ready, _, _ = select([rfd], [], [], _ready_timeout_sec)
+        return read(rfd, 1) if ready else b''
+    finally:
+        close(rfd)
@@ -1,3 +1,5 @@
 from .test1 import test as _test1
+from .test2 import test as _test2
+from .test3 import test as _test3
 
-exit(_test1())
+exit(_test1() or _test2() or _test3())
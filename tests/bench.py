@@ -0,0 +1,207 @@
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+from sys import executable, stderr
+from tempfile import TemporaryDirectory
+import subprocess as sub
+import json
+import time
+
+from .harness import make_env, clip_cmd, start_watcher, stop_watcher
+
+BASELINE = Path(__file__).resolve().parent / "bench_baseline.json"
+
+SIZES = [16, 4 << 10, 1 << 20, 16 << 20]
+FULL_SIZES = SIZES + [128 << 20, 256 << 20]
+CLIENTS = [1, 4]
+# 0.01 is the default
+POLL_INTERVALS = [0.1, 0.01]
+OPS_PER_CLIENT = 5
+REFERENCE_RUNS = 7
+
+# Latencies are compared as ratios to the start of an interpreter, which
+# imports the clip tool, measured in the same run, so a baseline holds on a
+# slower or busier machine too. Any error fails the run.
+# metric: lower is better
+COMPARED = ("copy_rel", "paste_rel")
+
+
+def _payload(tag: str, size: int) -> bytes:
+    # the stub clipboard logs the first line of each copy
+    return (f"{tag}\n".encode() + b'x' * size)[:size]
+
+
+def _wait_copied(log: Path, tag: str, timeout: float = 30) -> bool:
+    """
+    Waits for the copy to reach the stub clipboard, the value itself may be
+    replaced by another client's copy by then
+    """
+    line = f"{tag}\n"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if line in log.read_text().splitlines(keepends=True):
+                return True
+        except FileNotFoundError:
+            pass
+        time.sleep(0.001)
+    return False
+
+
+def _reference_ms(env: dict) -> float:
+    cmd = [executable, "-c", "import clipdis.clip"]
+    times = []
+    for _ in range(REFERENCE_RUNS):
+        begin = time.perf_counter()
+        sub.run(cmd, env=env, check=True)
+        times.append(time.perf_counter() - begin)
+    return median(times) * 1e3
+
+
+def _client(directory: Path, env: dict, client: int, size: int,
+            clients: int) -> dict:
+    log = Path(env["FAKE_CLIPBOARD_LOG"])
+    result = {"copy": [], "paste": [], "errors": 0}
+    for op in range(OPS_PER_CLIENT):
+        tag = f"{size}:{clients}:{client}:{op}"
+        data = _payload(tag, size)
+
+        begin = time.perf_counter()
+        sub.run(clip_cmd(directory, "--copy"), input=data, env=env)
+        if not _wait_copied(log, tag):
+            result["errors"] += 1
+            continue
+        result["copy"].append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        proc = sub.run(clip_cmd(directory, "--paste"), env=env,
+                       stdout=sub.PIPE, stderr=sub.DEVNULL)
+        elapsed = time.perf_counter() - begin
+        if len(proc.stdout) != size:
+            result["errors"] += 1
+            continue
+        result["paste"].append(elapsed)
+    return result
+
+
+def _case(directory: Path, env: dict, size: int, clients: int,
+          reference_ms: float) -> dict:
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(
+            lambda c: _client(directory, env, c, size, clients),
+            range(clients)))
+    wall = time.perf_counter() - begin
+
+    copies = [t for r in results for t in r["copy"]]
+    pastes = [t for r in results for t in r["paste"]]
+    moved = (len(copies) + len(pastes)) * size
+    copy_ms = median(copies) * 1e3 if copies else None
+    paste_ms = median(pastes) * 1e3 if pastes else None
+    return {
+        "copy_p50_ms": copy_ms,
+        "paste_p50_ms": paste_ms,
+        "copy_rel": copy_ms / reference_ms if copies else None,
+        "paste_rel": paste_ms / reference_ms if pastes else None,
+        "throughput_mb_s": moved / wall / 1e6,
+        "errors": sum(r["errors"] for r in results),
+    }
+
+
+def bench(sizes, clients, intervals) -> dict:
+    cases = {}
+    reference_ms = None
+    for interval in intervals:
+        with TemporaryDirectory() as tmp:
+            workdir = Path(tmp)
+            directory = workdir / "clipboard-dir"
+            directory.mkdir()
+            env = make_env(workdir, CLIPDIS_POLL_INTERVAL=str(interval),
+                           FAKE_CLIPBOARD_LOG=str(workdir / "clipboard.log"))
+            if reference_ms is None:
+                reference_ms = _reference_ms(env)
+            if not start_watcher(directory, env):
+                raise RuntimeError("watcher did not start")
+            try:
+                for size in sizes:
+                    for n in clients:
+                        key = f"size={size},clients={n},poll={interval}"
+                        print(f"Running {key}", file=stderr)
+                        cases[key] = _case(directory, env, size, n,
+                                           reference_ms)
+            finally:
+                stop_watcher(directory, env)
+    return {"reference_ms": reference_ms, "cases": cases}
+
+
+def errors(report: dict) -> list:
+    return [f"{key}: {case['errors']} failed operations"
+            for key, case in report["cases"].items() if case["errors"]]
+
+
+def compare(report: dict, baseline: dict, tolerance: float,
+            slack_ms: float) -> list:
+    regressions = []
+    # the absolute slack in units of this run's reference
+    slack = slack_ms / report["reference_ms"]
+    for key, base in baseline["cases"].items():
+        current = report["cases"].get(key)
+        if current is None:
+            continue
+        for metric in COMPARED:
+            old, new = base.get(metric), current.get(metric)
+            if old is None:
+                continue
+            if new is None:
+                regressions.append(f"{key}: {metric} has no successful runs")
+                continue
+            if new > old * (1 + tolerance) + slack:
+                regressions.append(f"{key}: {metric} {old:.3f} -> {new:.3f}")
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Copy/paste latency and throughput "
+                            "benchmark against a dry-run watcher")
+    parser.add_argument("--full", action="store_true",
+                        help="Include payloads of hundreds of megabytes")
+    parser.add_argument("--output", type=Path,
+                        help="Write JSON report to the file")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store the report as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed relative slowdown; default: 0.5")
+    parser.add_argument("--slack-ms", type=float, default=25,
+                        help="Allowed absolute slowdown; default: 25")
+    ns = parser.parse_args()
+
+    report = bench(FULL_SIZES if ns.full else SIZES, CLIENTS, POLL_INTERVALS)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if ns.output:
+        ns.output.write_text(text)
+
+    failed = errors(report)
+    for e in failed:
+        print(f"ERROR {e}", file=stderr)
+    if ns.save_baseline:
+        if failed:
+            print("Baseline is not saved, the run has errors", file=stderr)
+            return 1
+        ns.baseline.write_text(text + '\n')
+        return 0
+    if not ns.baseline.exists():
+        print(f"No baseline at {ns.baseline}", file=stderr)
+        return 1 if failed else 0
+
+    regressions = compare(report, json.loads(ns.baseline.read_text()),
+                          ns.tolerance, ns.slack_ms)
+    for r in regressions:
+        print(f"REGRESSION {r}", file=stderr)
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    exit(main())
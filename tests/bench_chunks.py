@@ -0,0 +1,117 @@
+from pathlib import Path
+from argparse import ArgumentParser
+from sys import stderr
+from tempfile import TemporaryDirectory
+import subprocess as sub
+import random
+import json
+import time
+
+from clipdis.chunks import ChunkStore
+
+from .harness import make_env, clip_cmd, start_watcher, stop_watcher
+
+# Copies a large text document, then edited versions of it, and measures
+# bytes written into the chunk store for each copy. Bytes written for
+# near-duplicate payloads should scale with the size of the edit.
+
+EDITED_LINES = [1, 10, 100, 1000]
+
+
+def _document(size: int, rng: random.Random) -> list:
+    words = [f"word{i}" for i in range(1000)]
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rng.choices(words, k=rng.randint(3, 15))) + '\n'
+        lines.append(line.encode())
+        total += len(line)
+    return lines
+
+
+def _edit(lines: list, count: int, rng: random.Random) -> list:
+    lines = list(lines)
+    for i in rng.sample(range(len(lines)), count):
+        lines[i] = b"edited " + lines[i]
+    return lines
+
+
+def _store_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def bench_store(size: int) -> list:
+    rng = random.Random(0)
+    doc = _document(size, rng)
+    results = []
+    with TemporaryDirectory() as tmp:
+        store = ChunkStore.open(Path(tmp), create=True)
+        data = b''.join(doc)
+        _, written = store.put(data)
+        results.append({"edited_lines": None, "payload": len(data),
+                        "written": written})
+        for count in EDITED_LINES:
+            data = b''.join(_edit(doc, count, rng))
+            begin = time.perf_counter()
+            _, written = store.put(data)
+            results.append({"edited_lines": count, "payload": len(data),
+                            "written": written,
+                            "put_ms": (time.perf_counter() - begin) * 1e3})
+    return results
+
+
+def bench_copy(size: int) -> list:
+    """The same, but through the clip tool and the watcher"""
+    rng = random.Random(0)
+    doc = _document(size, rng)
+    results = []
+    with TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        directory = workdir / "clipboard-dir"
+        directory.mkdir()
+        env = make_env(workdir)
+        if not start_watcher(directory, env, "--chunks"):
+            raise RuntimeError("watcher did not start")
+        try:
+            store = directory / ".chunks"
+            for count in [0] + EDITED_LINES:
+                data = b''.join(_edit(doc, count, rng))
+                before = _store_bytes(store)
+                begin = time.perf_counter()
+                sub.run(clip_cmd(directory, "--copy"), input=data, env=env,
+                        check=True)
+                results.append({"edited_lines": count, "payload": len(data),
+                                "written": _store_bytes(store) - before,
+                                "copy_ms":
+                                (time.perf_counter() - begin) * 1e3})
+        finally:
+            stop_watcher(directory, env)
+    return results
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Chunk store delta transfer "
+                            "benchmark")
+    parser.add_argument("--size", type=int, default=64 << 20,
+                        help="Document size; default: 64 MiB")
+    parser.add_argument("--max-ratio", type=float, default=0.05,
+                        help="Maximal written/payload ratio for an edit of "
+                        "one line; default: 0.05")
+    ns = parser.parse_args()
+
+    report = {"store": bench_store(ns.size), "copy": bench_copy(ns.size)}
+    print(json.dumps(report, indent=2))
+
+    failed = False
+    for name, results in report.items():
+        one_line = next(r for r in results if r["edited_lines"] == 1)
+        ratio = one_line["written"] / one_line["payload"]
+        if ratio > ns.max_ratio:
+            print(f"FAILED {name}: one line edit wrote {ratio:.1%} of the "
+                  "payload", file=stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
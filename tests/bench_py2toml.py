@@ -0,0 +1,59 @@
+from argparse import ArgumentParser
+from statistics import median
+import random
+import json
+import time
+
+from custom_setup import Py2TOML
+
+from .test2 import random_config
+
+# Converts generated configs of growing size: the time per key should stay
+# flat, as conversion is a single pass over the data.
+
+# (depth, width) of generated tables
+SHAPES = [(3, 6), (4, 8), (5, 8), (3, 24)]
+
+
+def _count_keys(data) -> int:
+    if isinstance(data, dict):
+        return sum(1 + _count_keys(v) for v in data.values())
+    if isinstance(data, list):
+        return sum(_count_keys(e) for e in data)
+    return 0
+
+
+def bench(repeat: int) -> list:
+    rng = random.Random(0)
+    converters = {"inline": Py2TOML(),
+                  "array_of_tables": Py2TOML(prefer_inline=False)}
+    results = []
+    for depth, width in SHAPES:
+        data = random_config(rng, depth, width)
+        keys = _count_keys(data)
+        for name, converter in converters.items():
+            times = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                text = converter.convert(data)
+                times.append(time.perf_counter() - begin)
+            t = median(times)
+            results.append({"depth": depth, "width": width, "keys": keys,
+                            "mode": name, "output_bytes": len(text),
+                            "convert_ms": t * 1e3,
+                            "us_per_key": t * 1e6 / keys,
+                            "mb_s": len(text) / t / 1e6})
+    return results
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Py2TOML conversion benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Conversions per config; default: 5")
+    ns = parser.parse_args()
+    print(json.dumps(bench(ns.repeat), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,177 @@
+from pathlib import Path
+from argparse import ArgumentParser
+from functools import partial
+from os import fork, waitpid, _exit, urandom
+from socket import socketpair, MSG_WAITALL
+from statistics import median
+from sys import stderr
+from tempfile import TemporaryDirectory
+import subprocess as sub
+import json
+import time
+
+from clipdis.common import State
+from clipdis.constants import STATEFILE
+from clipdis.record import StateRecord, read_payload, send_payload
+from clipdis.shm import SharedMemory, remove
+
+from .harness import make_env, clip_cmd, start_watcher, stop_watcher
+
+# Compares payload transports. "transport" runs a producer and a consumer
+# process, which pass payloads one after another: through the lane and data
+# slot files, through the lane and the shared memory ring, and through a unix
+# socket as a reference. "e2e" copies and pastes through the clip tool and a
+# watcher with and without --shm.
+
+SIZES = [16, 4 << 10, 64 << 10, 1 << 20, 16 << 20]
+FULL_SIZES = SIZES + [256 << 20]
+E2E_SIZES = [16, 1 << 20, 16 << 20]
+RING_SIZE = 8 << 20
+
+
+def _ops(size: int) -> int:
+    return max(4, min(2000, (256 << 20) // max(size, 1 << 16)))
+
+
+def _wait(predicate) -> None:
+    while not predicate():
+        time.sleep(0)
+
+
+def _lane(directory: Path, shared: bool):
+    record = StateRecord(directory / STATEFILE)
+    if shared:
+        SharedMemory.open(directory).attach(record)
+    return record.lane(State.COPY)
+
+
+def _lane_transfer(size: int, ops: int, shared: bool) -> float:
+    data = urandom(size)
+    with TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        memory = None
+        if shared:
+            memory = SharedMemory.create(directory, 2, RING_SIZE)
+        lane = _lane(directory, shared)
+        pid = fork()
+        if pid == 0:
+            lane = _lane(directory, shared)
+            for _ in range(ops):
+                _wait(lambda: lane.pending)
+                if read_payload(lane) != data:
+                    _exit(1)
+                lane.respond(State.DONE)
+            _exit(0)
+        begin = time.perf_counter()
+        for _ in range(ops):
+            _wait(lambda: not lane.pending)
+            send_payload(lane, data, partial(lane.request, State.COPY))
+        _wait(lambda: not lane.pending)
+        elapsed = time.perf_counter() - begin
+        if waitpid(pid, 0)[1] != 0:
+            raise RuntimeError("consumer received corrupted payload")
+        if memory is not None:
+            memory.close()
+            remove(directory)
+    return elapsed
+
+
+def _socket_transfer(size: int, ops: int) -> float:
+    data = urandom(size)
+    producer, consumer = socketpair()
+    pid = fork()
+    if pid == 0:
+        producer.close()
+        for _ in range(ops):
+            length = int.from_bytes(consumer.recv(8, MSG_WAITALL), "little")
+            buf = bytearray(length)
+            view = memoryview(buf)
+            done = 0
+            while done < length:
+                done += consumer.recv_into(view[done:])
+            consumer.sendall(b'k')
+        _exit(0)
+    consumer.close()
+    begin = time.perf_counter()
+    for _ in range(ops):
+        producer.sendall(size.to_bytes(8, "little"))
+        producer.sendall(data)
+        producer.recv(1)
+    elapsed = time.perf_counter() - begin
+    waitpid(pid, 0)
+    producer.close()
+    return elapsed
+
+
+def bench_transport(sizes) -> dict:
+    report = {}
+    for size in sizes:
+        ops = _ops(size)
+        for name, run in (("file", partial(_lane_transfer, shared=False)),
+                          ("shm", partial(_lane_transfer, shared=True)),
+                          ("socket", _socket_transfer)):
+            print(f"Running transport={name},size={size}", file=stderr)
+            elapsed = run(size, ops)
+            report[f"{name},size={size}"] = {
+                "ops": ops,
+                "op_us": elapsed / ops * 1e6,
+                "throughput_mb_s": size * ops / elapsed / 1e6,
+            }
+    return report
+
+
+def _e2e_case(directory: Path, env: dict, size: int, ops: int) -> dict:
+    copies, pastes = [], []
+    data = b'x' * size
+    for _ in range(ops):
+        begin = time.perf_counter()
+        sub.run(clip_cmd(directory, "--copy"), input=data, env=env,
+                check=True)
+        copies.append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        proc = sub.run(clip_cmd(directory, "--paste"), env=env,
+                       stdout=sub.PIPE, check=True)
+        pastes.append(time.perf_counter() - begin)
+        if len(proc.stdout) != size:
+            raise RuntimeError(f"pasted {len(proc.stdout)} of {size} bytes")
+    return {"copy_p50_ms": median(copies) * 1e3,
+            "paste_p50_ms": median(pastes) * 1e3}
+
+
+def bench_e2e(sizes, ops: int) -> dict:
+    report = {}
+    for name, args in (("file", ()), ("shm", ("--shm",))):
+        with TemporaryDirectory() as tmp:
+            workdir = Path(tmp)
+            directory = workdir / "clipboard-dir"
+            directory.mkdir()
+            env = make_env(workdir)
+            if not start_watcher(directory, env, *args):
+                raise RuntimeError("watcher did not start")
+            try:
+                for size in sizes:
+                    print(f"Running e2e={name},size={size}", file=stderr)
+                    report[f"{name},size={size}"] = \
+                        _e2e_case(directory, env, size, ops)
+            finally:
+                stop_watcher(directory, env)
+    return report
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Shared memory, file and socket "
+                            "transport benchmark")
+    parser.add_argument("--full", action="store_true",
+                        help="Include payloads of hundreds of megabytes")
+    parser.add_argument("--e2e-ops", type=int, default=5,
+                        help="Copies and pastes per end-to-end case")
+    ns = parser.parse_args()
+
+    report = {"transport": bench_transport(FULL_SIZES if ns.full else SIZES),
+              "e2e": bench_e2e(E2E_SIZES, ns.e2e_ops)}
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
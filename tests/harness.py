@@ -0,0 +1,110 @@
+from pathlib import Path
+from os import environ, chmod
+from sys import executable
+import subprocess as sub
+import time
+
+from clipdis.watcher import running_pid
+
+# Stand-in for the host clipboard: pyperclip picks xclip when DISPLAY is set,
+# so a script on PATH, which keeps the selection in a file, replaces it.
+# Writes go through a temporary file and rename, so a paste never sees a
+# partially copied value. When FAKE_CLIPBOARD_LOG is set, the first line of
+# every copied value is appended to it. FAKE_CLIPBOARD_DELAY makes pastes
+# take that many seconds, like a hung selection owner. When the file named by
+# FAKE_CLIPBOARD_DELAY_ONCE exists, the next paste takes as many seconds as
+# it holds, and removes it.
+XCLIP_STUB = """#!/bin/sh
+store="$FAKE_CLIPBOARD"
+for a in "$@"; do
+    if [ "$a" = "-o" ]; then
+        [ -n "$FAKE_CLIPBOARD_DELAY" ] && sleep "$FAKE_CLIPBOARD_DELAY"
+        once="$FAKE_CLIPBOARD_DELAY_ONCE"
+        if [ -n "$once" ] && [ -e "$once" ]; then
+            delay=$(cat "$once")
+            rm -f "$once"
+            sleep "$delay"
+        fi
+        cat "$store" 2>/dev/null
+        exit 0
+    fi
+done
+cat > "$store.$$"
+if [ -n "$FAKE_CLIPBOARD_LOG" ]; then
+    head -n 1 "$store.$$" >> "$FAKE_CLIPBOARD_LOG"
+fi
+mv "$store.$$" "$store"
+"""
+
+# Stand-in for docker: the container "exists" while FAKE_DOCKER_ALIVE file
+# exists, `docker run` blocks until it is removed.
+DOCKER_STUB = """#!/bin/sh
+case "$1" in
+    container)
+        [ -e "$FAKE_DOCKER_ALIVE" ] && echo "$FAKE_DOCKER_NAME"
+        ;;
+    run|start)
+        touch "$FAKE_DOCKER_ALIVE"
+        while [ -e "$FAKE_DOCKER_ALIVE" ]; do sleep 0.1; done
+        ;;
+esac
+exit 0
+"""
+
+CONTAINER_NAME = "clipdis-test"
+
+
+def make_env(workdir: Path, **extra: str) -> dict:
+    """
+    Creates stub `xclip` and `docker` executables in workdir/bin and returns
+    an environment, which puts them first on PATH.
+    """
+    bindir = workdir / "bin"
+    bindir.mkdir(exist_ok=True)
+    for name, text in (("xclip", XCLIP_STUB), ("docker", DOCKER_STUB)):
+        stub = bindir / name
+        stub.write_text(text)
+        chmod(stub, 0o755)
+
+    # copy(environ) would still write through to the process environment
+    env = dict(environ)
+    env.pop("WAYLAND_DISPLAY", None)
+    env["DISPLAY"] = env.get("DISPLAY", ":0")
+    env["PATH"] = f"{bindir}:{env.get('PATH', '')}"
+    env["FAKE_CLIPBOARD"] = str(workdir / "clipboard")
+    env["FAKE_DOCKER_ALIVE"] = str(workdir / "container-alive")
+    env["FAKE_DOCKER_NAME"] = CONTAINER_NAME
+    env.update(extra)
+    return env
+
+
+def clip_cmd(directory: Path, *args: str) -> list:
+    return [executable, "-m", "clipdis.run_clip",
+            "--directory", str(directory), *args]
+
+
+def _wait_for(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def start_watcher(directory: Path, env: dict, *args: str) -> bool:
+    """Starts detached dry-run watcher, returns when it is ready"""
+    cmd = [executable, "-m", "clipdis.run_watcher", "--dry-run",
+           "-d", str(directory), *args]
+    return sub.run(cmd, env=env).returncode == 0
+
+
+def wait_watcher(directory: Path, timeout: float = 5) -> bool:
+    return _wait_for(lambda: running_pid(directory) is not None, timeout)
+
+
+def stop_watcher(directory: Path, env: dict, timeout: float = 5) -> bool:
+    if running_pid(directory) is None:
+        return True
+    sub.run(clip_cmd(directory, "--halt"), env=env)
+    return _wait_for(lambda: running_pid(directory) is None, timeout)
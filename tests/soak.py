@@ -0,0 +1,193 @@
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from sys import executable, stderr
+from tempfile import TemporaryDirectory
+from threading import Event
+from zlib import crc32
+import subprocess as sub
+import random
+import json
+import time
+
+from .harness import make_env, clip_cmd, start_watcher, stop_watcher, \
+    wait_watcher, CONTAINER_NAME
+
+# Every copied payload carries a header line "<id> <size> <crc32>", so any
+# pasted value can be checked for tearing and matched to the copy, which
+# produced it. The stub clipboard logs the header of every value it receives,
+# which tells which copies reached the host.
+
+
+def _payload(op_id: str, size: int) -> bytes:
+    body = (op_id.encode() * (size // len(op_id) + 1))[:size]
+    return f"{op_id} {size} {crc32(body):08x}\n".encode() + body
+
+
+def _parse(data: bytes):
+    """Returns op id of a well-formed payload, None if torn"""
+    header, sep, body = data.partition(b'\n')
+    try:
+        op_id, size, crc = header.decode().split()
+        if not sep or len(body) != int(size) or crc32(body) != int(crc, 16):
+            return None
+    except ValueError:
+        return None
+    return op_id
+
+
+class _Soak:
+    def __init__(self, directory: Path, env: dict, ops: int, size_max: int,
+                 timeout: float):
+        self.directory = directory
+        self.env = env
+        self.ops = ops
+        self.size_max = size_max
+        self.timeout = timeout
+        self.copies = {}
+        self.pastes = []
+        self.halts = []
+
+    def _run(self, *args, data: bytes = b'') -> tuple:
+        begin = time.time()
+        try:
+            proc = sub.run(clip_cmd(self.directory, *args), input=data,
+                           env=self.env, stdout=sub.PIPE, stderr=sub.DEVNULL,
+                           timeout=self.timeout)
+            out = proc.stdout
+        except sub.TimeoutExpired:
+            out = None
+        return begin, time.time(), out
+
+    def worker(self, worker: int) -> None:
+        rng = random.Random(worker)
+        for n in range(self.ops):
+            if rng.random() < 0.5:
+                op_id = f"{worker}-{n}"
+                size = int(2 ** rng.uniform(0, self.size_max.bit_length()))
+                begin, end, _ = self._run("--copy",
+                                          data=_payload(op_id, size))
+                self.copies[op_id] = (begin, end)
+            else:
+                self.pastes.append(self._run("--paste"))
+
+    def halter(self, count: int, stop: Event) -> None:
+        """Halts and restarts the watcher `count` times during the run"""
+        for _ in range(count):
+            if stop.wait(random.uniform(1, 5)):
+                return
+            begin = time.time()
+            stop_watcher(self.directory, self.env)
+            start_watcher(self.directory, self.env)
+            self.halts.append((begin, time.time()))
+
+    def _in_halt(self, begin: float, end: float) -> bool:
+        return any(b <= end and begin <= e for b, e in self.halts)
+
+    def check(self, clipboard_log: Path) -> dict:
+        # the seed is put into the clipboard directly
+        delivered = {"seed"}
+        if clipboard_log.exists():
+            delivered.update(line.split(' ')[0] for line in
+                             clipboard_log.read_text().splitlines() if line)
+
+        errors = {"torn": 0, "phantom": 0, "lost_copy": 0, "lost_paste": 0}
+        for begin, end, out in self.pastes:
+            if not out:
+                if not self._in_halt(begin, end):
+                    errors["lost_paste"] += 1
+                continue
+            op_id = _parse(out)
+            if op_id is None:
+                errors["torn"] += 1
+            elif op_id not in self.copies or self.copies[op_id][0] > end:
+                errors["phantom"] += 1
+        for op_id, (begin, end) in self.copies.items():
+            if op_id not in delivered and not self._in_halt(begin, end):
+                errors["lost_copy"] += 1
+        return errors
+
+
+def _latency(spans) -> dict:
+    lat = sorted(end - begin for begin, end in spans)
+    if not lat:
+        return {}
+
+    def pct(p: float) -> float:
+        return lat[min(len(lat) - 1, int(len(lat) * p))] * 1e3
+
+    return {"count": len(lat), "p50_ms": pct(0.5), "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99), "max_ms": lat[-1] * 1e3}
+
+
+def soak(workers: int, ops: int, halts: int, size_max: int,
+         timeout: float) -> dict:
+    with TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        directory = workdir / "clipboard-dir"
+        directory.mkdir()
+        clipboard_log = workdir / "clipboard.log"
+        env = make_env(workdir, FAKE_CLIPBOARD_LOG=str(clipboard_log))
+
+        # real (not dry-run) start: watcher execs the stub `docker run`
+        docker = sub.Popen([executable, "-m", "clipdis.run_watcher",
+                            "-d", str(directory), "-D", "/clipboard",
+                            "-n", CONTAINER_NAME], env=env)
+        state = _Soak(directory, env, ops, size_max, timeout)
+        # seed the clipboard, so an empty paste always means no answer
+        Path(env["FAKE_CLIPBOARD"]).write_bytes(_payload("seed", 16))
+        state.copies["seed"] = (0, 0)
+        stop = Event()
+        try:
+            if not wait_watcher(directory):
+                raise RuntimeError("watcher did not start")
+
+            begin = time.time()
+            with ThreadPoolExecutor(workers + 1) as pool:
+                halter = pool.submit(state.halter, halts, stop)
+                list(pool.map(state.worker, range(workers)))
+                stop.set()
+                halter.result()
+            wall = time.time() - begin
+        finally:
+            stop.set()
+            stop_watcher(directory, env)
+            Path(env["FAKE_DOCKER_ALIVE"]).unlink(missing_ok=True)
+            docker.wait()
+
+        return {
+            "workers": workers,
+            "operations": len(state.copies) + len(state.pastes),
+            "halts": len(state.halts),
+            "throughput_ops_s": (len(state.copies) + len(state.pastes)) / wall,
+            "copy": _latency(state.copies.values()),
+            "paste": _latency((b, e) for b, e, _ in state.pastes),
+            "errors": state.check(clipboard_log),
+        }
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Concurrent copy/paste/halt soak "
+                            "test against a watcher with stub docker")
+    parser.add_argument("-w", "--workers", type=int, default=16)
+    parser.add_argument("-n", "--ops", type=int, default=200,
+                        help="Operations per worker; default: 200")
+    parser.add_argument("--halts", type=int, default=3,
+                        help="Watcher halt/restart cycles; default: 3")
+    parser.add_argument("--size-max", type=int, default=64 << 10,
+                        help="Maximal payload size; default: 65536")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="Per operation timeout in seconds")
+    ns = parser.parse_args()
+
+    report = soak(ns.workers, ns.ops, ns.halts, ns.size_max, ns.timeout)
+    print(json.dumps(report, indent=2))
+    failed = {k: v for k, v in report["errors"].items() if v}
+    if failed:
+        print(f"FAILED: {failed}", file=stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,17 +1,36 @@
 from pathlib import Path
-from os import environ
-from copy import copy
+from os import environ, kill
 from shutil import rmtree
 import subprocess as sub
 import pyperclip as pyc
 from sys import stderr
+from signal import SIGUSR1
 import time
 
+from clipdis.client import Session
+from clipdis.watcher import running_pid
 
-def _inspect(statefile, datafile):
-    with open(statefile, "rt") as sf:
-        with open(datafile, "rt") as df:
-            print(f"Datafile: '{df.read()}', Statefile: '{sf.read()}'")
+
+# the watcher may hold this much memory after a large copy and paste, and
+# keep at most RSS_GROWTH of it
+RSS_BUDGET = 32 << 20
+RSS_GROWTH = 4 << 20
+
+
+def _rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) << 10
+    return 0
+
+
+def _inspect(statefile):
+    from clipdis.record import StateRecord
+    record = StateRecord(statefile)
+    for lane in record.lanes:
+        print(f"Lane {lane.name}: {lane.read()}")
+    record.close()
 
 
 def test():
@@ -26,10 +45,9 @@ def test():
             testdir.mkdir()
 
         statefile = testdir / ".state"
-        datafile = testdir / ".data"
 
         # clip tool requires CLIPDIS_DIRECTORY environment variable to be set
-        env = copy(environ)
+        env = dict(environ)
         env["CLIPDIS_DIRECTORY"] = str(testdir)
 
         clip_cmd = ["python3", "-m", "clipdis.run_clip", "--directory", testdir]
@@ -47,7 +65,7 @@ def test():
             result = pyc.paste()
             if result != data:
                 print(f"Failed: expected '{data}', got '{result}'", file=stderr)
-                _inspect(statefile, datafile)
+                _inspect(statefile)
                 return 1
             else:
                 print("Success")
@@ -60,18 +78,116 @@ def test():
             result = proc.stdout
             if result != data:
                 print(f"Failed: expected '{data}', got '{result}'", file=stderr)
-                _inspect(statefile, datafile)
+                _inspect(statefile)
+                return 1
+            else:
+                print("Success")
+
+            print("Test 3: follow a growing stream")
+            lines = [f"line {i}\n" for i in range(100)]
+            with sub.Popen(copy_cmd + ["--follow", "--window", "70"],
+                           stdin=sub.PIPE, text=True, env=env) as follow:
+                for line in lines:
+                    follow.stdin.write(line)
+                    follow.stdin.flush()
+                    time.sleep(0.01)
+                follow.stdin.close()
+            # the watcher syncs followed stream periodically
+            time.sleep(1)
+            result = pyc.paste()
+            expected = ''.join(lines)[-70:]
+            if follow.returncode != 0 or result != expected:
+                print(f"Failed: expected '{expected}', got '{result}'",
+                      file=stderr)
+                _inspect(statefile)
+                return 1
+            else:
+                print("Success")
+
+            print("Test 4: watch clipboard values")
+            values = [pyc.paste(), "first value", "second value"]
+            with sub.Popen(paste_cmd + ["--watch", "--null"],
+                           stdout=sub.PIPE, env=env) as watch:
+                # the current value comes first
+                time.sleep(0.5)
+                for value in values[1:]:
+                    pyc.copy(value)
+                    time.sleep(0.5)
+                watch.terminate()
+                result = watch.stdout.read().decode().split("\0")
+            # the lease expires, the last published value is stale then
+            time.sleep(2.5)
+            values.append("third value")
+            pyc.copy(values[-1])
+            with sub.Popen(paste_cmd + ["--watch", "--null"],
+                           stdout=sub.PIPE, env=env) as watch:
+                time.sleep(1)
+                watch.terminate()
+                result += watch.stdout.read().decode().split("\0")
+            expected = values[:3] + ["", values[-1], ""]
+            if result != expected:
+                print(f"Failed: expected {expected}, got {result}",
+                      file=stderr)
+                _inspect(statefile)
+                return 1
+            else:
+                print("Success")
+
+            print("Test 5: client session")
+            values = [f"value {i}" for i in range(20)]
+            with Session(testdir) as session:
+                session.copy_many(values)
+                result = session.paste()
+            if result != values[-1] or pyc.paste() != values[-1]:
+                print(f"Failed: expected '{values[-1]}', got '{result}'",
+                      file=stderr)
+                _inspect(statefile)
+                return 1
+            else:
+                print("Success")
+
+            print("Test 6: watcher memory after a large copy and paste")
+            pid = running_pid(testdir)
+            before = _rss(pid)
+            data = "x" * (32 << 20)
+            sub.run(copy_cmd, input=data, text=True, env=env)
+            proc = sub.run(paste_cmd, stdout=sub.PIPE, text=True, env=env)
+
+            def grown() -> bool:
+                return after > RSS_BUDGET or after - before > RSS_GROWTH
+
+            # the copy lane may still be handling the copy under load
+            deadline = time.monotonic() + 5
+            after = _rss(pid)
+            while grown() and time.monotonic() < deadline:
+                time.sleep(0.1)
+                after = _rss(pid)
+            if len(proc.stdout) != len(data) or grown():
+                print(f"Failed: resident memory {before >> 10} KiB before, "
+                      f"{after >> 10} KiB after", file=stderr)
+                return 1
+            else:
+                print("Success")
+
+            print("Test 7: profile on demand")
+            kill(pid, SIGUSR1)
+            sub.run(paste_cmd, stdout=sub.DEVNULL, env=env)
+            kill(pid, SIGUSR1)
+            time.sleep(0.5)
+            reports = list(testdir.glob("clipdis-profile-*"))
+            if len(reports) != 1 or "cProfile" not in reports[0].read_text():
+                print(f"Failed: expected a report, got {reports}",
+                      file=stderr)
                 return 1
             else:
                 print("Success")
 
-            print("Test 3: halt watcher")
-            with open(testdir / ".state", "wt") as sf:
-                sf.write("halt")
+            print("Test 8: halt watcher")
+            sub.run(clip_cmd + ["--halt"], env=env)
             time.sleep(0.1)
             if watcher.poll() is None:
                 print("Failed: watcher not exited", file=stderr)
-                _inspect(statefile, datafile)
+                _inspect(statefile)
                 return 1
             elif watcher.poll() != 0:
                 print("Failed: watcher exited with error", file=stderr)
@@ -81,6 +197,45 @@ def test():
             else:
                 print("Success")
 
+            print("Test 9: paste fails fast without watcher")
+            start = time.monotonic()
+            proc = sub.run(paste_cmd, stdout=sub.PIPE, stderr=sub.PIPE,
+                           text=True, env=env)
+            elapsed = time.monotonic() - start
+            if proc.returncode == 0 or proc.stdout or elapsed > 3:
+                print(f"Failed: return code {proc.returncode}, "
+                      f"output '{proc.stdout}', {elapsed:.1f} s", file=stderr)
+                return 1
+            else:
+                print("Success")
+
+        print("Test 10: oversized and over-quota requests are rejected")
+        limits = ["--max-payload", "1", "--rate-limit", "0.5", "--rate-burst",
+                  "2"]
+        with sub.Popen(watcher_cmd + limits) as watcher:
+            time.sleep(1)
+            # the paste of Test 9 is handled first, it has its own source
+            source = dict(env)
+            source["CLIPDIS_SOURCE"] = "copies"
+            big = sub.run(copy_cmd, input="x" * (2 << 20), stderr=sub.PIPE,
+                          text=True, env=source)
+            copies = [sub.run(copy_cmd, input=f"value {i}", stderr=sub.PIPE,
+                              text=True, env=source) for i in range(3)]
+            other = dict(env)
+            other["CLIPDIS_SOURCE"] = "pastes"
+            paste = sub.run(paste_cmd, stdout=sub.PIPE, text=True, env=other)
+            sub.run(clip_cmd + ["--halt"], env=env)
+            rejected = [proc.returncode != 0 and "rejected" in proc.stderr
+                        for proc in [big] + copies]
+            if rejected != [True, False, False, True] or \
+                    paste.stdout != "value 1":
+                print(f"Failed: rejected {rejected}, pasted "
+                      f"'{paste.stdout}'", file=stderr)
+                _inspect(statefile)
+                return 1
+            else:
+                print("Success")
+
     finally:
         rmtree(testdir)
         pyc.copy(clipboard)
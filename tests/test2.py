@@ -0,0 +1,131 @@
+from datetime import datetime, date
+from sys import stderr
+import random
+
+from custom_setup import Py2TOML
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Py2TOML output is parsed back with tomllib and compared with the input
+
+PYPROJECT = {
+    "build-system": {
+        "requires": ["setuptools"],
+        "build-backend": "setuptools.build_meta"
+    },
+    "project": {
+        "name": "clipdis",
+        "authors": [{"name": "Gleb Zlatanov"}],
+        "classifiers": [],
+        "license": {"text": "MIT"},
+        "scripts": {"c": "clipdis.run_clip:run"},
+    },
+    "tool": {"setuptools": {"packages": {"find": {
+        "where": ["src"],
+        "include": ["clipdis"],
+        "namespaces": False
+    }}}}
+}
+
+VALUES = {
+    "string": "quotes \" ' and \\ backslash\ttab\nnewline \x7f",
+    "unicode": "юникод ключ",
+    "key with spaces": 1,
+    "": "empty key",
+    "numbers": [0, -1, 1.5, 1e+20],
+    "nested": [[1, [2, 3]], [], ["a"]],
+    "inline": {"table": {"a": 1, "b": [{"c": True}]}, "empty": {}},
+    "when": datetime(2024, 1, 2, 3, 4, 5),
+    "day": date(2024, 1, 2),
+}
+
+ARRAYS = {
+    "servers": [
+        {"name": "alpha", "ports": [1, 2], "tls": {"cert": "a.pem"}},
+        {"name": "beta", "hosts": [{"ip": "10.0.0.1"}, {"ip": "10.0.0.2"}]},
+    ],
+    "deep": {"er": {"est": {"level": {"items": [{"a": 1}, {"b": 2}]}}}},
+    "empty": {},
+}
+
+
+def random_config(rng: random.Random, depth: int, width: int) -> dict:
+    """Nested tables with scalars, arrays and arrays of tables"""
+    table = {}
+    for i in range(width):
+        kind = rng.randrange(6) if depth else rng.randrange(3)
+        key = f"key{i}"
+        if kind == 0:
+            table[key] = rng.randint(-1000, 1000)
+        elif kind == 1:
+            table[key] = f"value {rng.random()}"
+        elif kind == 2:
+            table[key] = [rng.random() for _ in range(rng.randrange(4))]
+        elif kind < 5:
+            table[key] = random_config(rng, depth - 1, width)
+        else:
+            table[key] = [random_config(rng, depth - 1, width)
+                          for _ in range(rng.randint(1, 3))]
+    return table
+
+
+CONVERTERS = [
+    Py2TOML(),
+    Py2TOML(prefer_inline=False),
+    Py2TOML(prefer_inline=1),
+    Py2TOML(table_heading_lvl=1, max_block_size=3),
+    Py2TOML(table_heading_lvl=6, indent_size=2, prefer_inline=False),
+]
+
+
+def _check(n: int, name: str, data: dict) -> int:
+    print(f"Test {n}: round trip of {name}")
+    for converter in CONVERTERS:
+        for root in ("", "root"):
+            text = converter.convert(data, root)
+            expected = {root: data} if root else data
+            try:
+                result = tomllib.loads(text)
+            except tomllib.TOMLDecodeError as e:
+                print(f"Failed: {e}:\n{text}", file=stderr)
+                return 1
+            if result != expected:
+                print(f"Failed: got {result}:\n{text}", file=stderr)
+                return 1
+    print("Success")
+    return 0
+
+
+def test():
+    if tomllib is None:
+        print("Skipped: neither tomllib nor tomli is available")
+        return 0
+
+    rng = random.Random(0)
+    cases = [("pyproject", PYPROJECT), ("values", VALUES),
+             ("arrays of tables", ARRAYS),
+             ("random configs",
+              {f"c{i}": random_config(rng, 4, 4) for i in range(20)})]
+    for n, (name, data) in enumerate(cases, 1):
+        if _check(n, name, data):
+            return 1
+
+    print(f"Test {len(cases) + 1}: arrays of tables notation")
+    text = Py2TOML(prefer_inline=False).convert(ARRAYS)
+    inline = Py2TOML(prefer_inline=2).convert(ARRAYS)
+    if text.count("[[servers]]") != 2 or "[[servers.hosts]]" \
+            not in text or "[[servers]]" in inline:
+        print(f"Failed:\n{text}\n{inline}", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(test())
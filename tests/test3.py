@@ -0,0 +1,287 @@
+from functools import partial
+from pathlib import Path
+from signal import SIGINT, SIGKILL
+from os import kill
+from sys import executable, stderr
+from tempfile import TemporaryDirectory
+import json
+import subprocess as sub
+import time
+
+from clipdis.chunks import ChunkStore
+from clipdis.common import State
+from clipdis.constants import STATEFILE
+from clipdis.record import StateRecord, send_payload
+from clipdis.watcher import running_pid
+
+from .harness import make_env, clip_cmd, start_watcher, stop_watcher, \
+    wait_watcher
+
+# Failures of the host side: the watcher runs detached against the stub
+# clipboard of the harness, which may be made slow.
+
+
+def _hung_paste(directory: Path, workdir: Path) -> int:
+    print("Test 1: paste fails, when the host clipboard hangs")
+    env = make_env(workdir, FAKE_CLIPBOARD_DELAY="5")
+    if not start_watcher(directory, env, "--stall-timeout", "1"):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    try:
+        start = time.monotonic()
+        proc = sub.run(clip_cmd(directory, "--paste"), stdout=sub.PIPE,
+                       stderr=sub.PIPE, text=True, env=env, timeout=10)
+        elapsed = time.monotonic() - start
+    finally:
+        stop_watcher(directory, env)
+    if proc.returncode == 0 or elapsed > 4:
+        print(f"Failed: return code {proc.returncode}, {elapsed:.1f} s",
+              file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _copy_after_follow(directory: Path, workdir: Path) -> int:
+    print("Test 2: a copy after a followed stream stays in the clipboard")
+    env = make_env(workdir)
+    if not start_watcher(directory, env):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    try:
+        sub.run(clip_cmd(directory, "--copy", "--follow"), input="stream\n",
+                text=True, env=env)
+        sub.run(clip_cmd(directory, "--copy"), input="copy", text=True,
+                env=env)
+        # the followed stream would be synced by now
+        time.sleep(1.5)
+        result = Path(env["FAKE_CLIPBOARD"]).read_text()
+    finally:
+        stop_watcher(directory, env)
+    if result != "copy":
+        print(f"Failed: expected 'copy', got '{result}'", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _group(directory: Path, workdir: Path) -> int:
+    print("Test 3: clipboard group of two watchers")
+    env = make_env(workdir)
+    other = workdir / "other-dir"
+    other.mkdir()
+    group = ["--group", str(workdir / "group"), "--group-sync-delay", "0.5"]
+    host = Path(env["FAKE_CLIPBOARD"])
+    host.write_text("host")
+    if not (start_watcher(directory, env, "-n", "first", *group) and
+            start_watcher(other, env, "-n", "second", *group)):
+        print("Failed: watchers did not start", file=stderr)
+        stop_watcher(directory, env)
+        return 1
+
+    def paste(where: Path) -> str:
+        return sub.run(clip_cmd(where, "--paste"), stdout=sub.PIPE,
+                       text=True, env=env).stdout
+
+    try:
+        sub.run(clip_cmd(directory, "--copy"), input="first", text=True,
+                env=env)
+        # served from the group, before it is synced to the host
+        shared = paste(other)
+        time.sleep(1)
+        synced = host.read_text()
+        sub.run(clip_cmd(other, "--copy"), input="second", text=True,
+                env=env)
+        # a host copy before the sync is newer than the group value
+        host.write_text("host again")
+        time.sleep(1)
+        kept = host.read_text()
+        pasted = paste(directory)
+    finally:
+        stop_watcher(directory, env)
+        stop_watcher(other, env)
+    result = [shared, synced, kept, pasted]
+    expected = ["first", "first", "host again", "host again"]
+    if result != expected:
+        print(f"Failed: expected {expected}, got {result}", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _cancelled_paste(directory: Path, workdir: Path) -> int:
+    print("Test 4: interrupted paste is cancelled")
+    once = workdir / "delay"
+    logfile = workdir / "watcher.log"
+    env = make_env(workdir, FAKE_CLIPBOARD_DELAY_ONCE=str(once))
+    Path(env["FAKE_CLIPBOARD"]).write_text("value")
+    if not start_watcher(directory, env, "-l", str(logfile)):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    try:
+        once.write_text("5")
+        proc = sub.Popen(clip_cmd(directory, "--paste"), stdout=sub.PIPE,
+                         stderr=sub.DEVNULL, env=env)
+        # the watcher is reading the host clipboard
+        deadline = time.monotonic() + 5
+        while once.exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.3)
+        proc.send_signal(SIGINT)
+        proc.communicate(timeout=5)
+        start = time.monotonic()
+        pasted = sub.run(clip_cmd(directory, "--paste"), stdout=sub.PIPE,
+                         text=True, env=env, timeout=10).stdout
+        elapsed = time.monotonic() - start
+    finally:
+        stop_watcher(directory, env)
+    log = logfile.read_text() if logfile.exists() else ""
+    if proc.returncode != 130 or "cancelled" not in log or \
+            pasted != "value" or elapsed > 2:
+        print(f"Failed: return code {proc.returncode}, pasted '{pasted}' "
+              f"in {elapsed:.1f} s, cancel logged: {'cancelled' in log}",
+              file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _killed_shm_watcher(directory: Path, workdir: Path) -> int:
+    print("Test 5: copy after a killed --shm watcher")
+    env = make_env(workdir)
+    Path(env["FAKE_CLIPBOARD"]).write_text("host")
+    if not start_watcher(directory, env, "--shm"):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    kill(running_pid(directory), SIGKILL)
+    deadline = time.monotonic() + 5
+    while running_pid(directory) is not None and \
+            time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not start_watcher(directory, env):
+        print("Failed: watcher did not restart", file=stderr)
+        return 1
+    data = "x" * (100 << 10)
+    try:
+        wait_watcher(directory)
+        sub.run(clip_cmd(directory, "--copy"), input=data, text=True,
+                env=env)
+        time.sleep(0.5)
+        result = Path(env["FAKE_CLIPBOARD"]).read_text()
+        left = (directory / ".shm").exists()
+    finally:
+        stop_watcher(directory, env)
+    if result != data or left:
+        print(f"Failed: copied {len(result)} of {len(data)} bytes, "
+              f".shm left: {left}", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _group_slow_host(directory: Path, workdir: Path) -> int:
+    print("Test 6: group copy does not wait for a slow host clipboard")
+    once = workdir / "delay"
+    env = make_env(workdir, FAKE_CLIPBOARD_DELAY_ONCE=str(once))
+    other = workdir / "other-dir"
+    other.mkdir()
+    group = ["--group", str(workdir / "group")]
+    Path(env["FAKE_CLIPBOARD"]).write_text("host")
+    if not (start_watcher(directory, env, "-n", "first", *group) and
+            start_watcher(other, env, "-n", "second", *group)):
+        print("Failed: watchers did not start", file=stderr)
+        stop_watcher(directory, env)
+        return 1
+    try:
+        once.write_text("3")
+        sub.run(clip_cmd(directory, "--copy"), input="first", text=True,
+                env=env)
+        time.sleep(0.5)
+        start = time.monotonic()
+        pasted = sub.run(clip_cmd(other, "--paste"), stdout=sub.PIPE,
+                         text=True, env=env, timeout=10).stdout
+        elapsed = time.monotonic() - start
+    finally:
+        stop_watcher(directory, env)
+        stop_watcher(other, env)
+    if pasted != "first" or elapsed > 1:
+        print(f"Failed: pasted '{pasted}' in {elapsed:.1f} s", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _chunked_over_limit(directory: Path, workdir: Path) -> int:
+    print("Test 7: chunked copy above --max-payload is rejected")
+    env = make_env(workdir)
+    Path(env["FAKE_CLIPBOARD"]).write_text("host")
+    if not start_watcher(directory, env, "--chunks", "--max-payload", "1"):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    record = StateRecord(directory / STATEFILE)
+    try:
+        # past the clip tool's own check, the lane carries a manifest only
+        lane = record.lane(State.COPY)
+        send_payload(lane, b"line\n" * (1 << 20),
+                     partial(lane.request, State.COPY),
+                     ChunkStore.open(directory))
+        deadline = time.monotonic() + 10
+        while lane.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        status = lane.read().status
+        result = Path(env["FAKE_CLIPBOARD"]).read_text()
+    finally:
+        record.close()
+        stop_watcher(directory, env)
+    if status != State.REJECTED or result != "host":
+        print(f"Failed: status {status}, host clipboard has {len(result)} "
+              "bytes", file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def _traced(directory: Path, workdir: Path) -> int:
+    print("Test 8: a traced copy and paste are rebuilt by the trace tool")
+    env = make_env(workdir)
+    if not start_watcher(directory, env, "--trace"):
+        print("Failed: watcher did not start", file=stderr)
+        return 1
+    try:
+        sub.run(clip_cmd(directory, "--copy"), input="traced", text=True,
+                env=env)
+        pasted = sub.run(clip_cmd(directory, "--paste"), stdout=sub.PIPE,
+                         text=True, env=env).stdout
+    finally:
+        stop_watcher(directory, env)
+    proc = sub.run([executable, "-m", "clipdis.trace", "analyze",
+                    str(directory / ".trace")], stdout=sub.PIPE, text=True,
+                   env=env)
+    timelines, _, summary = proc.stdout.partition("\n{")
+    # the paste ends last, its timeline holds the watcher's answer
+    paste = timelines[timelines.find("paste pid="):]
+    counts = {op: s["count"] for op, s in json.loads("{" + summary).items()}
+    if pasted != "traced" or counts != {"copy": 1, "paste": 1} \
+            or "watcher state_write" not in paste:
+        print(f"Failed: pasted {pasted!r}, analyze printed:\n{proc.stdout}",
+              file=stderr)
+        return 1
+    print("Success")
+    return 0
+
+
+def test() -> int:
+    for case in (_hung_paste, _copy_after_follow, _group, _cancelled_paste,
+                 _killed_shm_watcher, _group_slow_host, _chunked_over_limit,
+                 _traced):
+        with TemporaryDirectory() as tmp:
+            workdir = Path(tmp)
+            directory = workdir / "clipboard-dir"
+            directory.mkdir()
+            if case(directory, workdir):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(test())